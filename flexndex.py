@@ -32,14 +32,72 @@
 #  OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
-import re, argparse, string, cStringIO
-from contextlib import closing
+# Modules only some runs need are imported where they are used, to keep
+# the start up of a run on a small document short: argparse, hashlib,
+# tempfile, shutil, copy, resource, multiprocessing and cProfile.
+import re, cStringIO, os, stat, mmap, sys, marshal, zlib, bisect
+import thread, array, time
+from contextlib import closing, contextmanager
 
-# command line arguments
-args = argparse.Namespace()
+# Messages go to the flexndex logger, warnings and errors at their levels
+# and the --verbose output at INFO for -v, DEBUG for -vv and TRACE for
+# more.  Messages in loops test a flag taken from the logger once before
+# the loop so they cost nothing when the level is off.  A library user
+# sees the messages only if they configure logging.
+#
+# The logging module is imported only when it is needed, it and the
+# threading module it loads are most of the import time otherwise.  Until
+# logging is imported, by the application to configure it or by a message
+# main() sends to standard error, nothing could receive a message so none
+# is made.
+TRACE, DEBUG, INFO, WARNING, ERROR = 5, 10, 20, 30, 40
+
+class Log(object):
+    def __init__(self, name):
+        self.name = name; self.logger = None; self.level = None
+    def get(self):
+        "The logger, importing logging and making it if not yet"
+        if self.logger is None:
+            import logging
+            logging.addLevelName(TRACE, 'TRACE')
+            self.logger = logging.getLogger(self.name)
+            self.logger.addHandler(logging.NullHandler())
+            if self.level is not None: self.to_stderr(self.level)
+        return self.logger
+    def to_stderr(self, level):
+        "Send the messages at level and above to standard error"
+        self.level = level
+        if self.logger is None: return
+        import logging
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self.logger.addHandler(handler); self.logger.setLevel(level)
+    def isEnabledFor(self, level):
+        if (self.logger is None and 'logging' not in sys.modules
+            and (self.level is None or level < self.level)): return False
+        return self.get().isEnabledFor(level)
+    def log(self, level, msg, *args):
+        if self.isEnabledFor(level): self.logger.log(level, msg, *args)
+    def debug(self, msg, *args): self.log(DEBUG, msg, *args)
+    def info(self, msg, *args): self.log(INFO, msg, *args)
+    def warning(self, msg, *args): self.log(WARNING, msg, *args)
+    def error(self, msg, *args): self.log(ERROR, msg, *args)
+
+log = Log('flexndex')
+
+# A regex compiled when it is first used, so importing flexndex or a run
+# that never needs a regex does not compile it.  Each attribute of the
+# compiled regex is kept on first use so later uses cost no more.
+class LazyRe(object):
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern; self.flags = flags
+    def __getattr__(self, name):
+        attr = getattr(re.compile(self.pattern, self.flags), name)
+        setattr(self, name, attr)
+        return attr
 
 # predefined attributes
-attributes = { 'sp' : ' ', 'nl' : '\n' }
+predefined_attributes = { 'sp' : ' ', 'nl' : '\n' }
 
 # Settings file, hierarchical keys, values text only
 #
@@ -87,13 +145,14 @@ class Settings:
     def parse(self, file):
         "Parse a settings file object into this Settings object"
         prefix = []; line = file.readline()
+        trace = log.isEnabledFor(TRACE)
         while line :
             line = line.strip()
-            if args.verbose > 3: print "Config line:", len(line), line,
+            if trace: log.log(TRACE, "Config line: %d %s", len(line), line)
             if len(line) > 0 and line[0] != '#':
                 if line[0] == '[':
                     prefix = line[1:-1].split('.')
-                    if args.verbose > 3: print "=>", prefix
+                    if trace: log.log(TRACE, "=> %s", prefix)
                 else:
                     k,v = line.split('=',1)
                     key = list(prefix)
@@ -101,25 +160,184 @@ class Settings:
                     v = v.strip()
                     while len(v) > 0 and v[-1] == '\\':
                         v = v[:-1]+strip(file.readline())
-                    if args.verbose > 3: print "=>", key, '=', v
+                    if trace: log.log(TRACE, "=> %s = %s", key, v)
                     self.set(key, v)
             else:
-                if args.verbose > 3: print 'ignored'
+                if trace: log.log(TRACE, 'ignored')
             line = file.readline()
+    def dump(self):
+        "Return the settings as nested (value, dict) tuples for marshal"
+        if not self.d: return (self.v, {})
+        return (self.v, dict([ (k, s.dump()) for k, s in self.d.iteritems() ]))
+    def load(self, tree):
+        "Set this Settings object from a dump()"
+        self.v = tree[0]
+        for k, t in tree[1].items():
+            if k not in self.d: self.d[k] = Settings()
+            self.d[k].load(t)
     def debug_print(self, leader=''):
-        print leader, "=", self.v
+        log.log(TRACE, "%s = %s", leader, self.v)
         for k in self.d.keys():
             if leader: l = leader + '.' + k
             else: l = k
             self.d[k].debug_print(l)
 
-# return shared prefix of two iterables
-def shared_prefix(i1, i2):
-    pref = []
-    for a,b in zip(i1, i2):
-        if a!=b: break
-        pref.append(a)
-    return pref
+# Index of one target, a tree of terms built by pass 1
+#
+# Each node is a term, children are the nodes of the next level keyed by
+# term, None if there are none, and rnos the numbers of the targets of
+# entries ending at this node in document order, None, an int for the
+# common single target, or an array.  The text and attrs of a target are
+# kept by the Indexer in lists indexed by its number.
+#
+# Selecting the subtree for a prefix of terms is a lookup per term and the
+# sorted order of the children of a node is kept once made, so walking a
+# subtree in default order costs only the entries walked.  Orders sorted by
+# a sort=levels key are kept per node and key.
+
+class TermNode(object):
+    __slots__ = ('children', 'rnos', 'keys', 'sorts')
+    def __init__(self):
+        self.children = None
+        self.rnos = None
+        self.keys = None
+        self.sorts = None
+    def add(self, terms, rno):
+        "Add target rno for the entry with the terms below this node"
+        node = self
+        for t in terms:
+            node.sorts = None
+            if node.children is None: node.children = {}
+            n = node.children.get(t)
+            if n is None:
+                n = node.children[t] = TermNode()
+                node.keys = None
+            node = n
+        node.sorts = None
+        r = node.rnos
+        if r is None: node.rnos = rno
+        elif isinstance(r, array.array): r.append(rno)
+        else: node.rnos = array.array('l', (r, rno))
+    def count(self):
+        "Number of nodes below this one, ie distinct terms"
+        n = 0; stack = [ self ]
+        while stack:
+            node = stack.pop()
+            if node.children:
+                n += len(node.children); stack.extend(node.children.itervalues())
+        return n
+    def targets(self):
+        "Sequence of the target numbers of the entry ending here"
+        r = self.rnos
+        if r is None: return ()
+        if isinstance(r, array.array): return r
+        return (r,)
+    def sorted_keys(self):
+        "Return the sorted list of child terms"
+        if self.keys is None: self.keys = sorted(self.children or ())
+        return self.keys
+    def find(self, terms):
+        "Return the node for terms below this node or None"
+        node = self
+        for t in terms:
+            if node.children is None: return None
+            node = node.children.get(t)
+            if node is None: break
+        return node
+    def items(self, path):
+        "Return list of (terms, targets) of entries below, in sorted order"
+        items = []
+        def walk(node):
+            if node.rnos is not None: items.append((tuple(path), node.targets()))
+            children = node.children
+            for k in node.sorted_keys():
+                path.append(k); walk(children[k]); path.pop()
+        walk(self)
+        return items
+    def sorted_items(self, path, minl, maxl):
+        "Return items() sorted by terms minl to maxl, the list is kept"
+        if self.sorts is None: self.sorts = {}
+        items = self.sorts.get((minl, maxl))
+        if items is None:
+            items = self.items(path)
+            items.sort(key=lambda e: e[0][minl:maxl+1])
+            self.sorts[(minl, maxl)] = items
+        return items
+
+# An entry in the output, its terms, the sequence of its target numbers
+# and if it is one of the entries split from a multi target entry
+
+class Entry(object):
+    __slots__ = ('terms', 'targets', 'multi')
+    def __init__(self, terms, targets=(), multi=False):
+        self.terms = terms; self.targets = targets; self.multi = multi
+    def __repr__(self):
+        return 'Entry(%r, %r, %r)' % (self.terms, list(self.targets), self.multi)
+
+# Both the following make the entries for the ixhere selecting selargs
+# in one pass.  If complete is 'e' or 't' entries are generated for the
+# internal levels of the hierarchy of terms, for 't' entries with multiple
+# targets are split into an entry per target.  Only entries with minl+1 to
+# maxl levels are returned.
+
+def tree_entries(root, selargs, complete, minl=0, maxl=1000):
+    "Entries in default sorted order, a walk of the tree"
+    node = root.find(selargs)
+    if node is None: return []
+    entries = []
+    if complete:
+        for d in range(max(1, minl+1), min(len(selargs), maxl+1)):
+            entries.append(Entry(selargs[:d]))
+    path = list(selargs)
+    def walk(node):
+        d = len(path)
+        if minl < d <= maxl:
+            if node.rnos is not None:
+                targets = node.targets()
+                if complete == 't' and len(targets) > 1:
+                    for t in targets:
+                        entries.append(Entry(tuple(path), (t,), True))
+                else:
+                    entries.append(Entry(tuple(path), targets))
+            elif complete:
+                entries.append(Entry(tuple(path)))
+        if d < maxl:
+            children = node.children
+            for k in node.sorted_keys():
+                path.append(k); walk(children[k]); path.pop()
+    walk(node)
+    return entries
+
+def list_entries(items, complete, minl=0, maxl=1000):
+    """Generate the entries from an iterable of (terms, targets) in any
+       order, the entries of each item are generated before the next item
+       is taken"""
+    last = ()
+    for terms, targets in items:
+        if complete:
+            n = 0
+            for a, b in zip(terms, last):
+                if a != b: break
+                n += 1
+            while n+1 < len(terms):
+                n += 1
+                if minl < n <= maxl: yield Entry(terms[:n])
+            if complete == 't' and len(targets) > 1:
+                if minl < len(terms) <= maxl:
+                    for t in targets:
+                        yield Entry(terms, (t,), True)
+                last = terms
+                continue
+        if minl < len(terms) <= maxl: yield Entry(terms, targets)
+        last = terms
+
+def shown_entries(entries, nlevels):
+    "Generate the entries with at most nlevels terms, warning of the others"
+    for e in entries:
+        if len(e.terms) > nlevels:
+            log.warning("Warning, not enough style levels for target terms %s",
+                        list(e.terms))
+        else: yield e
 
 # Layout of entry style in class Estyle
 #
@@ -138,12 +356,22 @@ def shared_prefix(i1, i2):
 # {ixtext} - 'text' defined by target attrlist, or term if no text
 # {xxxx} - where xxxx is anything else defined in the target attrlist
 
-class Estyle:
+class Estyle(object):
+    templates = ('text_internal', 'link_last', 'text_last', 'multi_target')
     def __init__(self, settings=Settings()):
-        self.text_internal = settings.get('text_internal', '')
-        self.link_last = settings.get('link_last', '')
-        self.text_last = settings.get('text_last', '')
-        self.multi_target = settings.get('multi_target', '')
+        self.text_internal = Template(settings.get('text_internal', ''))
+        self.link_last = Template(settings.get('link_last', ''))
+        self.text_last = Template(settings.get('text_last', ''))
+        self.multi_target = Template(settings.get('multi_target', ''))
+    def dump(self):
+        "Return the built style as a dict for marshal"
+        return dict((k, getattr(self, k).dump()) for k in self.templates)
+    @classmethod
+    def load(cls, d):
+        "Return the style of a dump() without building it again"
+        e = object.__new__(cls)
+        for k in cls.templates: setattr(e, k, Template.load(d[k]))
+        return e
 
 # Layout of info in class Style
 #
@@ -154,32 +382,117 @@ class Estyle:
 # postfix - markup/text after the index
 # empty_message - message if no entries, default 'Index Empty'
 
-class Style:
+class Style(object):
+    templates = ('entry_start', 'entry_end', 'prefix', 'postfix', 'empty_message')
+    template_lists = ('col_starts', 'col_ends', 'row_starts', 'row_ends')
     def __init__(self, settings=Settings()):
-        if args.verbose > 2: settings.debug_print()
+        if log.isEnabledFor(TRACE): settings.debug_print()
         self.complete = settings.get('complete', 'n')
-        self.entry_start = settings.get('entry_start', '')
-        self.entry_end = settings.get('entry_end', '')
-        self.prefix = settings.get('prefix', '')
-        self.postfix = settings.get('postfix', '')
-        self.empty_message = settings.get('empty_message', 'Empty Index')
+        self.entry_start = Template(settings.get('entry_start', ''))
+        self.entry_end = Template(settings.get('entry_end', ''))
+        self.prefix = Template(settings.get('prefix', ''))
+        self.postfix = Template(settings.get('postfix', ''))
+        self.empty_message = Template(settings.get('empty_message', 'Empty Index'))
         self.levels = []
         l = settings.get(('levels',), None)
         if l is not None:
             self.levels = [ Estyle( l.get((i,)) ) for i in l.sorted_keys() ]
         c = settings.get(('col_start',), None)
-        if c is not None: self.col_starts = c.key_sorted_values()
-        else: self.col_starts = ['']
+        if c is not None: self.col_starts = map(Template, c.key_sorted_values())
+        else: self.col_starts = [Template()]
         c = settings.get(('col_end',), None)
-        if c is not None: self.col_ends = c.key_sorted_values()
-        else: self.col_ends = ['']
+        if c is not None: self.col_ends = map(Template, c.key_sorted_values())
+        else: self.col_ends = [Template()]
         c = settings.get(('row_start',), None)
-        if c is not None: self.row_starts = c.key_sorted_values()
-        else: self.row_starts = ['']
+        if c is not None: self.row_starts = map(Template, c.key_sorted_values())
+        else: self.row_starts = [Template()]
         c = settings.get(('row_end',), None)
-        if c is not None: self.row_ends = c.key_sorted_values()
-        else: self.row_ends = ['']
+        if c is not None: self.row_ends = map(Template, c.key_sorted_values())
+        else: self.row_ends = [Template()]
+    def dump(self):
+        "Return the built style as a dict for marshal"
+        d = dict((k, getattr(self, k).dump()) for k in self.templates)
+        for k in self.template_lists:
+            d[k] = [ t.dump() for t in getattr(self, k) ]
+        d['complete'] = self.complete
+        d['levels'] = [ e.dump() for e in self.levels ]
+        return d
+    @classmethod
+    def load(cls, d):
+        "Return the style of a dump() without building it again"
+        s = object.__new__(cls)
+        for k in cls.templates: setattr(s, k, Template.load(d[k]))
+        for k in cls.template_lists:
+            setattr(s, k, map(Template.load, d[k]))
+        s.complete = d['complete']
+        s.levels = map(Estyle.load, d['levels'])
+        return s
+
+# The phase of an Indexer without stats, does nothing
+class NoPhase:
+    def __enter__(self): pass
+    def __exit__(self, *exc): pass
+
+no_phase = NoPhase()
 
+# The styles of a configuration.  The configuration texts confs are only
+# parsed when a style is first needed, unless config, their parsed
+# Settings.dump(), is given, eg by a StyleCache.  Each Style is built or
+# loaded from built, a dump() of the styles built before, the first time
+# an ixhere uses it, so only the settings of the styles used are loaded.
+# phase times the work, see Indexer.phase().  Indexers copied from one
+# share its Styles, so the work is under its lock.
+class Styles(object):
+    def __init__(self, confs=(), config=None, built=None, phase=None):
+        self.confs = confs; self.config = config
+        self.dumps = dict(built or {}); self.built = {}
+        self.phase = phase or (lambda name: no_phase)
+        self.lock = thread.allocate_lock()
+    def _config(self):
+        # the configuration, parsing it if not yet, under the lock
+        if self.config is None:
+            with self.phase('config parse'):
+                settings = Settings()
+                for c in self.confs:
+                    with closing(cStringIO.StringIO(c)) as fo:
+                        settings.parse(fo)
+                if log.isEnabledFor(TRACE): settings.debug_print()
+                self.config = settings.dump()
+        return self.config
+    def settings(self):
+        "The configuration as a Settings.dump()"
+        with self.lock: return self._config()
+    def has(self, name):
+        "If the configuration defines style name for any backend"
+        with self.lock:
+            return name in self._config()[1].get('styles', (None, {}))[1]
+    def get(self, name, backend):
+        "The Style name for backend, None if it is not defined"
+        key = (name, backend)
+        style = self.built.get(key)
+        if style is not None: return style
+        with self.lock:
+            style = self.built.get(key)
+            if style is not None: return style
+            with self.phase('style load'):
+                if key in self.dumps:
+                    style = Style.load(self.dumps.pop(key))
+                else:
+                    st = self._config()[1].get('styles')
+                    for k in key:
+                        if st is not None: st = st[1].get(k)
+                    if st is None: return None
+                    log.debug("Building style %s backend %s", name, backend)
+                    settings = Settings(); settings.load(st)
+                    style = Style(settings)
+            self.built[key] = style
+        return style
+    def dump(self):
+        "Return the styles built or loaded as a dict for marshal"
+        with self.lock:
+            d = dict(self.dumps)
+            d.update((k, s.dump()) for k, s in self.built.items())
+            return d
 
 # Built-in style definitions
 
@@ -191,49 +504,49 @@ anchors = { 'xhtml11' : '<a id="ix{ixtgt}"></a>' ,
 styles_config = """
 [styles.simple-dotted.xhtml11]
 levels.1.text_internal = {ixterm}.
-levels.1.link_last = <a href="#ix{ixtgt}">{ixterm}</a>
+levels.1.link_last = <a href="{ixfile}#ix{ixtgt}">{ixterm}</a>
 levels.1.text_last = {ixterm}{sp}
-levels.1.multi_target = <a href="#ix{ixtgt}">{ixtext} </a>
+levels.1.multi_target = <a href="{ixfile}#ix{ixtgt}">{ixtext} </a>
 levels.2.text_internal = {ixterm}.
-levels.2.link_last = <a href="#ix{ixtgt}">{ixterm}</a>
+levels.2.link_last = <a href="{ixfile}#ix{ixtgt}">{ixterm}</a>
 levels.2.text_last = {ixterm}{sp}
-levels.2.multi_target = <a href="#ix{ixtgt}">{ixtext} </a>
+levels.2.multi_target = <a href="{ixfile}#ix{ixtgt}">{ixtext} </a>
 levels.3.text_internal = {ixterm}.
-levels.3.link_last = <a href="#ix{ixtgt}">{ixterm}</a>
+levels.3.link_last = <a href="{ixfile}#ix{ixtgt}">{ixterm}</a>
 levels.3.text_last = {ixterm}{sp}
-levels.3.multi_target = <a href="#ix{ixtgt}">{ixtext}</a>
+levels.3.multi_target = <a href="{ixfile}#ix{ixtgt}">{ixtext}</a>
 entry_start = <p>
 entry_end = </p>{nl}
 
 [styles.simple-grouped.xhtml11]
 levels.1.text_internal = 
-levels.1.link_last = <p><a href="#ix{ixtgt}">{ixterm}</a>
+levels.1.link_last = <p><a href="{ixfile}#ix{ixtgt}">{ixterm}</a>
 levels.1.text_last = <p>{ixterm}{sp}
-levels.1.multi_target = <a href="#ix{ixtgt}">{ixtext}</a>{sp}
+levels.1.multi_target = <a href="{ixfile}#ix{ixtgt}">{ixtext}</a>{sp}
 levels.2.text_internal = 
-levels.2.link_last = <p style="text-indent:{ixindent}em;"><a href="#ix{ixtgt}">{ixterm}</a>
+levels.2.link_last = <p style="text-indent:{ixindent}em;"><a href="{ixfile}#ix{ixtgt}">{ixterm}</a>
 levels.2.text_last = <p style="text-indent:{ixindent}em;">{ixterm}{sp}
-levels.2.multi_target = <a href="#ix{ixtgt}">{ixtext}</a>{sp}
+levels.2.multi_target = <a href="{ixfile}#ix{ixtgt}">{ixtext}</a>{sp}
 levels.3.text_internal = 
-levels.3.link_last = <p style="text-indent:{ixindent}em;"><a href="#ix{ixtgt}">{ixterm}</a>
+levels.3.link_last = <p style="text-indent:{ixindent}em;"><a href="{ixfile}#ix{ixtgt}">{ixterm}</a>
 levels.3.text_last = <p style="text-indent:{ixindent}em;">{ixterm}{sp}
-levels.3.multi_target = <a href="#ix{ixtgt}">{ixtext}</a>{sp}
+levels.3.multi_target = <a href="{ixfile}#ix{ixtgt}">{ixtext}</a>{sp}
 entry_end = </p>{nl}
 complete = e
 
 [styles.column-grouped.xhtml11]
 levels.1.text_internal = 
-levels.1.link_last = <p><a href="#ix{ixtgt}">{ixterm}</a> {text}
+levels.1.link_last = <p><a href="{ixfile}#ix{ixtgt}">{ixterm}</a> {text}
 levels.1.text_last = <p>{ixterm} {text?|}{sp}
-levels.1.multi_target = <a href="#ix{ixtgt}">{ixtext}</a>{sp}
+levels.1.multi_target = <a href="{ixfile}#ix{ixtgt}">{ixtext}</a>{sp}
 levels.2.text_internal = 
-levels.2.link_last = <p style="text-indent:{ixindent}em;"><a href="#ix{ixtgt}">{ixterm}</a> {text?|}
+levels.2.link_last = <p style="text-indent:{ixindent}em;"><a href="{ixfile}#ix{ixtgt}">{ixterm}</a> {text?|}
 levels.2.text_last = <p style="text-indent:{ixindent}em;">{ixterm} {text?|}{sp}
-levels.2.multi_target = <a href="#ix{ixtgt}">{ixtext}</a>{sp}
+levels.2.multi_target = <a href="{ixfile}#ix{ixtgt}">{ixtext}</a>{sp}
 levels.3.text_internal = 
-levels.3.link_last = <p style="text-indent:{ixindent}em;"><a href="#ix{ixtgt}">{ixterm}</a> {text?|}
+levels.3.link_last = <p style="text-indent:{ixindent}em;"><a href="{ixfile}#ix{ixtgt}">{ixterm}</a> {text?|}
 levels.3.text_last = <p style="text-indent:{ixindent}em;">{ixterm} {text?|}{sp}
-levels.3.multi_target = <a href="#ix{ixtgt}">{ixtext}</a>{sp}
+levels.3.multi_target = <a href="{ixfile}#ix{ixtgt}">{ixtext}</a>{sp}
 prefix=<table width="100%"><tr>
 postfix=</tr></table>
 col_start.1 = <td valign="top">
@@ -244,18 +557,27 @@ complete = t
 
 """
 
-styles = {}
-
 default_style = 'simple-dotted'
 
-inds = {}
+# A dict of attrs shared by the markers with the same attrlist, so it must
+# not be changed.  marshal only dumps plain dicts, see Cache.save().
+class FrozenAttrs(dict):
+    def frozen(self, *args, **kwargs):
+        raise TypeError('shared attrs may not be changed')
+    __setitem__ = __delitem__ = clear = pop = popitem = frozen
+    setdefault = update = frozen
+    def __reduce__(self):
+        return (FrozenAttrs, (dict(self),))
+
+# the attrs of targets without any, shared by them all
+empty_attrs = FrozenAttrs()
 
 # parse attrlist into a pair containing:
 # tuple of positional attrs and dict of keyword attrs
 # comma and equals can be included by including twice
-att_split_re = re.compile(r',(?!,)')
-att_key_re = re.compile(r'=(?!=)')
-att_rep_re = re.compile(r'([=,])\1')
+att_split_re = LazyRe(r',(?!,)')
+att_key_re = LazyRe(r'=(?!=)')
+att_rep_re = LazyRe(r'([=,])\1')
 def attr_tuple(attlist):
     atts = [ x.strip() for x in att_split_re.split(attlist) ]
     if len(atts) == 1 and atts[0] == '':
@@ -267,301 +589,1550 @@ def attr_tuple(attlist):
         else: patts.append( s[0] )
     return (tuple(patts), katts)
 
-# output to file o after substituting attributes in strings
-# print warning if key not found and leave in output
-# accepts a list of mapping objects for subs values searched left to right
-# kwargs for subs values, searched before any dicts
-# attributes global searched last
-subs_re = re.compile(r'({(?!{).*?}(?!}))')
-def subout(o, sstr, *dicts, **kwargs):
-    def getkey(key):
-        s = kwargs.get(key)
-        if s is not None: return s
-        for d in dicts:
-            s = d.get(key)
-            if s is not None: return s
-        s = attributes.get(key)
-        return s
-    bits = [ z.replace('{{','{').replace('}}', '}') for z in subs_re.split(sstr) ]
-    bits.append('{}')
-    for textbit, subsbit in zip(*[iter(bits)]*2):
-        o.write(textbit)
-        if subsbit != '{}':
+# Memo of attr_tuple() for scan(), as the same attrlists are repeated many
+# times in a document.  The results have interned terms and FrozenAttrs
+# shared by all the markers with the attrlist.  It is bounded by keeping
+# two generations of size attrlists each, a lookup that misses the new
+# generation moves the attrlist from the old, and when the new is full it
+# becomes the old, dropping the attrlists not used during a generation,
+# which is close to least recently used at the cost of a dict lookup.
+# Each Indexer has one, shared by its copies, scan() holds the lock while
+# it uses it.
+class AttrCache:
+    def __init__(self, size=4096):
+        self.size = size; self.new = {}; self.old = {}
+        self.hits = 0; self.misses = 0
+        self.lock = thread.allocate_lock()
+    def get(self, attlist):
+        "attr_tuple() of attlist, frozen"
+        r = self.new.get(attlist)
+        if r is None:
+            r = self.old.get(attlist)
+            if r is None:
+                self.misses += 1
+                r = self.freeze(*attr_tuple(attlist))
+            else: self.hits += 1
+            if len(self.new) >= self.size:
+                self.old = self.new; self.new = {}
+            self.new[attlist] = r
+        else: self.hits += 1
+        return r
+    @staticmethod
+    def freeze(terms, attrs):
+        "The pair of terms and attrs interned and frozen"
+        return (tuple(map(intern, terms)),
+                FrozenAttrs(attrs) if attrs else empty_attrs)
+
+# Compiled substitution template
+#
+# The markup string is split into literal text and substitutions once when
+# the template is built, rendering is then a lookup per substitution and a
+# join, no regex work.  Each op is a pair of literal text and either None
+# or a tuple of (key, conditional default or None, original markup).
+subs_re = LazyRe(r'({(?!{).*?}(?!}))')
+class Template:
+    def __init__(self, sstr=''):
+        self.source = sstr
+        ops = []; text = []
+        bits = [ z.replace('{{','{').replace('}}', '}') for z in subs_re.split(sstr) ]
+        bits.append('{}')
+        for textbit, subsbit in zip(*[iter(bits)]*2):
+            text.append(textbit)
+            if subsbit == '{}': continue
             cond = subsbit[1:-1].split('?', 1)
-            s = getkey(cond[0])
             if len(cond) > 1: # conditional attribute
-                cop = cond[1][0]
+                cop = cond[1][:1]
                 if cop == '|':
-                    if s is not None: o.write(s)
-                    else: o.write(cond[1][1:])
+                    ops.append((''.join(text), (cond[0], cond[1][1:], subsbit)))
+                    text = []
                 else:
-                    print "Warning: Unknown conditional operator", cop, "left in output"
-                    o.write(subsbit)
+                    log.warning("Warning: Unknown conditional operator %s left in output", cop)
+                    text.append(subsbit)
             else:
-                if s is not None:
-                    o.write(s)
+                ops.append((''.join(text), (cond[0], None, subsbit)))
+                text = []
+        self.tail = ''.join(text)
+        self.ops = tuple(ops)
+    def __repr__(self):
+        return 'Template(%r)' % self.source
+    def dump(self):
+        "Return the compiled template as a tuple for marshal"
+        return (self.source, self.ops, self.tail)
+    @staticmethod
+    def load(t):
+        "Return the Template of a dump() without compiling it again"
+        tp = Template()
+        tp.source, tp.ops, tp.tail = t
+        return tp
+    def format(self, keys):
+        """Return the template as a % format of a dict of keys, or None if
+           it substitutes any other attribute"""
+        if any(op[1][0] not in keys for op in self.ops): return None
+        return ''.join([ t.replace('%', '%%') + '%%(%s)s' % k for t, (k, d, b) in self.ops ] +
+                       [ self.tail.replace('%', '%%') ])
+    def render(self, dicts=(), kwargs={}):
+        "Return the template text with attributes substituted"
+        if not self.ops: return self.tail
+        out = []
+        for textbit, (key, default, subsbit) in self.ops:
+            out.append(textbit)
+            s = kwargs.get(key)
+            if s is None:
+                for d in dicts:
+                    s = d.get(key)
+                    if s is not None: break
+            if s is None:
+                if default is not None: s = default
                 else:
-                    print "Warning: attribute", subsbit, "not found, left in output"
-                    o.write(subsbit)
-
-ix_re = re.compile(r'<!-- ix (?P<target>\S+) <(?P<attrlist>[^>]*)> -->')
-ixhere_re = re.compile(r'<!-- ixhere (?P<target>\S+) <(?P<attrlist>[^>]*)> -->')
-
-def pass1():
-    if args.verbose > 1 : print "Pass 1"
-    ic = 0
-    with open(args.infile, 'r') as f:
-        rno = 0
-        for line in f:
-            for m in ix_re.finditer(line):
-                if args.verbose > 1 : print 'Found ix in: ', line,
-                ic += 1
-                tgt = m.group('target')
-                if tgt not in inds: inds[tgt] = {}
-                a, d = attr_tuple(m.group('attrlist'))
-                if a not in inds[tgt]:
-                    inds[tgt][a] = {}
-                inds[tgt][a][str(rno)] = d
-                rno += 1
-    if args.verbose > 0 : print 'Pass 1 found', ic, 'ix entries'
-
-levels_re = re.compile(r'(\d)*-?(\d)*')
-sort_levels_re = re.compile(r'levels\s*(\d)*-?(\d)*')
-
-# returns tuple:
-#   entry list in output order
-#   list of tuples of start/end counts
-#   list of tuples of per-entry templates, start, end
-#   list of tuples per-count templates, start, end
-cattr_re = re.compile(r'(?P<num>\d+)(?P<id>(i|l)(r|c))(?P<break>.\d+)?')
+                    log.warning("Warning: attribute %s not found, left in output", subsbit)
+                    s = subsbit
+            out.append(s)
+        out.append(self.tail)
+        return ''.join(out)
+
+# Input source, the whole input as one buffer
+#
+# The stream is a path or a file object.  Regular files are memory mapped.
+# Other inputs are read into memory, or if longer than spool_size copied to a
+# temporary file which is mapped.
+class Source:
+    def __init__(self, stream, spool_size=64<<20):
+        if isinstance(stream, basestring):
+            self.f = open(stream, 'rb'); self.own = True
+        else:
+            self.f = stream; self.own = False
+        self.spool = None
+        try: st = os.fstat(self.f.fileno())
+        except (AttributeError, IOError, ValueError): st = None
+        if st is not None and stat.S_ISREG(st.st_mode) and st.st_size > 0:
+            self.buf = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            data = self.f.read(spool_size + 1)
+            if len(data) <= spool_size: self.buf = data
+            else:
+                import tempfile, shutil
+                self.spool = tempfile.TemporaryFile()
+                self.spool.write(data); del data
+                shutil.copyfileobj(self.f, self.spool)
+                self.spool.flush()
+                self.buf = mmap.mmap(self.spool.fileno(), 0, access=mmap.ACCESS_READ)
+        self.lno_pos = 0; self.lno = 1
+    def lineno(self, pos):
+        "Line number of offset pos, counted on from the last one asked for"
+        if pos < self.lno_pos: self.lno_pos = 0; self.lno = 1
+        while self.lno_pos < pos:
+            end = min(pos, self.lno_pos + (1<<20))
+            self.lno += self.buf[self.lno_pos:end].count('\n')
+            self.lno_pos = end
+        return self.lno
+    def write(self, o, start, end=None):
+        "Write the buffer from start to end to file o without copying"
+        if end is None: end = len(self.buf)
+        if end > start: o.write(buffer(self.buf, start, end - start))
+    def close(self):
+        if isinstance(self.buf, mmap.mmap): self.buf.close()
+        if self.spool is not None: self.spool.close()
+        if self.own: self.f.close()
+
+# line number of an offset in a Source, only counted if it is printed
+class LineNo:
+    def __init__(self, src, pos):
+        self.src = src; self.pos = pos
+    def __str__(self):
+        return str(self.src.lineno(self.pos))
+
+# ix and ixhere comments, neither can span lines
+marker_re = LazyRe(r'<!-- (?P<kind>ix|ixhere) (?P<target>\S+) <(?P<attrlist>[^>\n]*)> -->')
+
+# Scan buf from start to end, which must be at the start of a line, and
+# return the list of markers found with offsets relative to start:
+#   ('ix', offset after the comment, target, terms, target attrs)
+#   ('ixhere', offset of the line start, target, selargs, attrs)
+# Only the first ixhere on a line is used, its index is output before the
+# line, so it goes before any ix on the same line.
+#
+# A plain string search for the start of a marker skips the text before
+# the first, all of a chunk without any, then the one combined regex finds
+# the rest.  Matching each candidate the search finds separately is faster
+# only where markers are sparse, and much slower where they are dense, see
+# flexndex_bench.py --suite scan.  The attrlists are parsed through attrs,
+# an AttrCache, a new one if not given.
+marker_start = '<!-- ix'
+def scan(buf, start, end, attrs=None):
+    markers = []; here_line = -1
+    pos = buf.find(marker_start, start, end)
+    if pos < 0: return markers
+    if attrs is None: attrs = AttrCache()
+    with attrs.lock:
+        for m in marker_re.finditer(buf, pos, end):
+            if m.group('kind') == 'ixhere':
+                line = max(buf.rfind('\n', start, m.start()) + 1, start)
+                if line == here_line: continue
+                here_line = line
+                selargs, hereattrs = attrs.get(m.group('attrlist'))
+                i = len(markers)
+                while i > 0 and markers[i-1][1] > line - start: i -= 1
+                markers.insert(i, ('ixhere', line - start, m.group('target'), selargs, hereattrs))
+            else:
+                a, d = attrs.get(m.group('attrlist'))
+                markers.append(('ix', m.end() - start, m.group('target'), a, d))
+    return markers
+
+# Split buf into chunks of whole lines for the cache.  After size bytes a
+# chunk ends at the first line end whose preceding bytes hash to a multiple
+# of 64, so where chunks end depends on the content, and an edit only
+# changes the chunks around it.
+def chunks(buf, size=1<<15):
+    start = 0; n = len(buf)
+    while start < n:
+        end = n; pos = start + size
+        while pos < n:
+            nl = buf.find('\n', pos)
+            if nl < 0: break
+            pos = nl + 1
+            if zlib.crc32(buf[max(nl-16, start):nl]) & 63 == 0 or pos - start > 4*size:
+                end = pos; break
+        yield start, end
+        start = end
+
+# Scan an input buffer, generates (offset, digest, markers) for its
+# chunks, so only the markers of one chunk need exist at a time.  If
+# known, a set of chunk digests, is given the buffer is split into chunks
+# which are hashed, the markers of known chunks are None as they are not
+# scanned.  Otherwise the chunks are just blocks of lines and the digest
+# None.  attrs is the AttrCache for scan().
+def scan_parts(buf, known=None, size=1<<20, attrs=None):
+    if known is None:
+        start = 0; n = len(buf)
+        while start < n:
+            end = buf.find('\n', min(start + size, n))
+            end = n if end < 0 else end + 1
+            yield start, None, scan(buf, start, end, attrs)
+            start = end
+        return
+    import hashlib
+    for start, end in chunks(buf):
+        digest = hashlib.md5(buffer(buf, start, end - start)).digest()
+        if digest in known: yield start, digest, None
+        else: yield start, digest, scan(buf, start, end, attrs)
+
+# Configuration kept between runs by --style-cache, a marshal file of a
+# dict with:
+#   version: the class version
+#   config: digest of the configuration files and backend last used
+#   configs: digest of configuration -> (settings, styles) where settings
+#     is the parsed configuration, see Settings.dump(), and styles the
+#     styles built from it, see Styles.dump()
+# The configurations of the last size runs with different configurations
+# are kept.  The Indexer sets styles to the Styles of its configuration
+# for save().
+class StyleCache(object):
+    version = 1
+    size = 8
+    def __init__(self, path=None):
+        self.path = path; self.old = {}
+        if path is not None:
+            try:
+                with open(path, 'rb') as f:
+                    d = marshal.load(f)
+                if isinstance(d, dict) and d.get('version') == self.version:
+                    self.old = d
+            except (IOError, EOFError, ValueError, TypeError):
+                pass
+        self.config = None; self.styles = None
+    def set_config(self, digest):
+        "Set the configuration digest, returns cached (settings, styles) or None"
+        self.config = digest
+        return self.old.get('configs', {}).get(digest)
+    def data(self):
+        "Return the dict saved"
+        configs = self.old.get('configs', {})
+        order = [ c for c in self.old.get('order', []) if c != self.config ]
+        order = [ self.config ] + order[:self.size-1]
+        configs[self.config] = (self.styles.settings(), self.styles.dump())
+        return { 'version' : self.version, 'config' : self.config,
+                 'configs' : dict((c, configs[c]) for c in order if c in configs),
+                 'order' : order }
+    def save(self):
+        "Save to the file, if there is one"
+        if self.path is None: return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            marshal.dump(self.data(), f)
+        os.rename(tmp, self.path)
+
+# Cache kept between runs by --cache, a StyleCache of one configuration
+# whose dict also has:
+#   chunks: digest of a chunk of input -> markers
+#   blocks: digest of an ixhere, its index contents and the links from its
+#     document to the outputs -> index output
+# Chunks do not depend on the configuration so they are kept when it
+# changes, the index output is not.  Only the chunks and blocks used by a
+# run are saved.  Without a path it is only kept in memory, for the runs
+# of one process, see next_run().
+class Cache(StyleCache):
+    version = 2
+    size = 1
+    def __init__(self, path=None):
+        StyleCache.__init__(self, path)
+        self.chunks = {}; self.blocks = {}; self.sigs = {}; self.hot = {}
+        self.chunk_hits = 0; self.block_hits = 0; self.block_uses = 0
+        self.known_chunks = None
+    def next_run(self):
+        """Start another run in this process, with what this run used
+           cached as if saved and loaded, but the chunks kept frozen"""
+        self.old['config'] = self.config
+        self.old['chunks'] = {}; self.old['blocks'] = self.blocks
+        self.hot = self.chunks
+        self.chunks = {}; self.blocks = {}; self.sigs = {}
+        self.chunk_hits = 0; self.block_hits = 0; self.block_uses = 0
+        self.known_chunks = None
+    def set_config(self, digest):
+        "Set the configuration digest, returns cached (settings, styles) or None"
+        if self.old.get('config') != digest:
+            self.old.pop('blocks', None)
+        return StyleCache.set_config(self, digest)
+    def known(self):
+        "Set of digests of the cached chunks"
+        if self.known_chunks is None:
+            self.known_chunks = set(self.old.get('chunks', {})) | set(self.hot)
+        return self.known_chunks
+    def chunk(self, digest, markers, rno, fno):
+        """Record the markers of a chunk starting at rno in file fno, if
+           markers is None they are cached, returns the markers"""
+        if markers is None:
+            markers = self.chunks.get(digest) or self.hot.get(digest)
+            if markers is None:
+                markers = [ m[:3] + AttrCache.freeze(m[3], m[4])
+                            for m in self.old['chunks'][digest] ]
+            self.chunk_hits += 1
+        self.chunks[digest] = markers
+        # the contents of a target's index depend only on the chunks with
+        # its ix markers, the rno they start at and the file they are in
+        import hashlib
+        for t in set(m[2] for m in markers if m[0] == 'ix'):
+            if t not in self.sigs: self.sigs[t] = hashlib.md5()
+            self.sigs[t].update('%s%d,%d' % (digest, rno, fno))
+        return markers
+    def block_key(self, target, selargs, hereattrs, links):
+        import hashlib
+        sig = self.sigs.get(target)
+        if sig is not None: sig = sig.digest()
+        return hashlib.md5(marshal.dumps((target, selargs,
+            sorted(hereattrs.items()), sig, links))).digest()
+    def has_block(self, key):
+        "True if the output of an ixhere is cached, not counted as a use"
+        return key in self.blocks or key in self.old.get('blocks', {})
+    def block(self, key):
+        "Cached output of an ixhere or None"
+        self.block_uses += 1
+        b = self.blocks.get(key)
+        if b is None:
+            b = self.old.get('blocks', {}).get(key)
+            if b is not None: self.blocks[key] = b
+        if b is not None: self.block_hits += 1
+        return b
+    def data(self):
+        d = StyleCache.data(self)
+        # marshal needs the FrozenAttrs as plain dicts
+        d['chunks'] = dict((k, [ m[:4] + (dict(m[4]),) for m in v ])
+                           for k, v in self.chunks.iteritems())
+        d['blocks'] = self.blocks
+        return d
+    def save(self):
+        StyleCache.save(self)
+        log.info('Cache reused %d of %d chunks %d of %d indexes', self.chunk_hits,
+                 len(self.chunks), self.block_hits, self.block_uses)
+
+levels_re = LazyRe(r'(\d)*-?(\d)*')
+sort_levels_re = LazyRe(r'levels\s*(\d)*-?(\d)*')
+
+# Lay out the entries for the cols attribute, returns None if it is not
+# valid, else a tuple of:
+#   list of groups in output order, each a list of entries in output
+#     order, where None is an empty cell padding a row
+#   lists of start and of end templates for each group, each used in turn
+#   lists of start and of end templates for each entry of a group by its
+#     position in the group, each used in turn
+# A column layout (c) outputs a group per column with the row templates
+# around each entry, a row layout (r) a group per row with the column
+# templates around each entry.  Linear (l) columns have consecutive
+# entries, interlaced (i) ones every cols'th entry, so they read across.
+# Empty groups are omitted.  Without cols all the entries are one group
+# with the entry templates.
+cattr_re = LazyRe(r'(?P<num>\d+)(?P<id>(i|l)(r|c))(?P<break>.\d+)?')
 def collimate(entries, hereattrs, styleob, lno):
     colattr = hereattrs.get('cols')
+    trace = log.isEnabledFor(TRACE)
     if colattr is None:
-        if args.verbose > 2: print "Not collimated"
-        return ( entries,
-                 [(0, len(entries))],
-                 [(styleob.entry_start, styleob.entry_end)],
-                 [('', '')] )
-    if args.verbose > 2: print "Collimated"
+        if trace: log.log(TRACE, "Not collimated")
+        return ( [ entries ], [ Template() ], [ Template() ],
+                 [ styleob.entry_start ], [ styleob.entry_end ] )
+    if trace: log.log(TRACE, "Collimated")
     mo = cattr_re.match(colattr)
-    if mo is None:
-        print "Error: unrecognised column attribute", colattr, "at line", lno
-        return [None, None, None, None]
+    if mo is None or int(mo.group('num')) < 1:
+        log.error("Error: unrecognised column attribute %s at line %s", colattr, lno)
+        return None
     cols = int(mo.group('num'))
-    # get list of column lengths
-    counts = [len(entries)/cols] * cols
-    for i in range(len(entries) % cols): counts[i] += 1
+    order, direction = mo.group('id')
     if mo.group('break') is not None:
         blevel = int(mo.group('break')[1:])
-        if args.verbose > 1: print "Break at", blevel
+        log.debug("Break at %d", blevel)
     else: blevel = None
-    # adjust column lengths for break level
-    cincr = 0
-    for i in range(cols):
-        c = counts[i] + cincr; b = c; cincr = c
-        if blevel is not None and i < cols-1: 
-            cmax = c + counts[i+1]/2; bmin = c - counts[i]/2;
-            if args.verbose > 2: print "c, cmax, bmin", c, cmax, bmin
-            while len(entries[c][0]) > blevel and len(entries[b][0]) > blevel:
-                c += 1; b -= 1
-                if args.verbose > 2: print "c,b",c,b
-                if c >= cmax and b <= bmin :
-                    c = cincr
-                    break
+    if order == 'l':
+        bounds = column_breaks(entries, cols, blevel)
+        if trace: log.log(TRACE, "    Column bounds %s", bounds)
+        columns = [ entries[bounds[i]:bounds[i+1]] for i in range(cols) ]
+    else:
+        columns = [ entries[i::cols] for i in range(cols) ]
+    cols = (styleob.col_starts, styleob.col_ends)
+    rows = (styleob.row_starts, styleob.row_ends)
+    if direction == 'c':
+        groups = columns; gstyles = cols; estyles = rows
+    else:
+        groups = [ [ c[r] if r < len(c) else None for c in columns ]
+                   for r in range(max(len(c) for c in columns)) ]
+        gstyles = rows; estyles = cols
+    if trace:
+        log.log(TRACE, "    Group lengths %s", [ len(g) for g in groups ])
+        log.log(TRACE, "    Group styles %s", gstyles)
+        log.log(TRACE, "    Entry styles %s", estyles)
+    return ( [ g for g in groups if g ], ) + gstyles + estyles
+
+# Positions of the starts of cols linear columns of entries and its end.
+# The columns are as near the same length as possible, if blevel is given
+# each column after the first starts at the nearest entry of blevel or
+# fewer levels, the earlier if two are as near, unless there is none
+# within half the length of the longer column either side.  The entries
+# of blevel or fewer levels are found once and the nearest to each column
+# start is a bisect of them.
+def column_breaks(entries, cols, blevel=None):
+    n = len(entries)
+    counts = [ n/cols ] * cols
+    for i in range(n % cols): counts[i] += 1
+    if blevel is not None:
+        breaks = [ i for i, e in enumerate(entries) if len(e.terms) <= blevel ]
+    bounds = [ 0 ]; nominal = 0
+    for i in range(cols - 1):
+        nominal += counts[i]; c = nominal
+        if blevel is not None:
+            k = max(counts[i], counts[i+1]) / 2
+            j = bisect.bisect_left(breaks, nominal)
+            after = before = None
+            if j < len(breaks) and breaks[j] <= nominal + k - 1: after = breaks[j]
+            if j > 0 and breaks[j-1] >= nominal - k + 1: before = breaks[j-1]
+            if before is not None and (after is None or
+                                       nominal - before <= after - nominal):
+                c = before
+            elif after is not None: c = after
+        bounds.append(max(c, bounds[-1]))
+    bounds.append(n)
+    return bounds
+
+# Output collected as a list of strings, joined to be written at once
+class Block(list):
+    write = list.append
+
+# Buffered output to file f, writes are collected until there are size
+# bytes to write to f in one call.  Writes of size or more go straight
+# through, so large spans of the input written as buffers are not copied.
+# If direct and f has a file descriptor the output is written with
+# os.write, skipping the file object.  Only the writer is flushed, it does
+# not flush or close f.
+class OutputWriter:
+    def __init__(self, f, size=1<<20, direct=False):
+        self.f = f; self.size = size; self.fd = None
+        self.parts = []; self.n = 0
+        if direct:
+            try: fd = f.fileno()
+            except (AttributeError, IOError, ValueError): fd = None
+            if fd is not None:
+                f.flush(); self.fd = fd
+    def write(self, s):
+        n = len(s)
+        if n >= self.size:
+            self.flush(); self.out(s)
+        else:
+            if type(s) is not str: s = str(s)
+            self.parts.append(s); self.n += n
+            if self.n >= self.size: self.flush()
+    def flush(self):
+        if self.parts:
+            self.out(''.join(self.parts))
+            self.parts = []; self.n = 0
+    def out(self, s):
+        if self.fd is None: self.f.write(s); return
+        s = buffer(s)
+        while len(s):
+            s = buffer(s, os.write(self.fd, s))
+
+# copy n bytes from file f to file o in blocks
+def copy_bytes(f, o, n, bsize=1<<16):
+    while n > 0:
+        b = f.read(min(n, bsize))
+        if not b: break
+        o.write(b); n -= len(b)
+
+# true if stream, a path or file object, is a regular file
+def is_file(stream):
+    if isinstance(stream, basestring): return os.path.isfile(stream)
+    try: return stat.S_ISREG(os.fstat(stream.fileno()).st_mode)
+    except (AttributeError, IOError, ValueError): return False
+
+# A document added to the index by Indexer.scan()
+#
+# stream is what the document was read from, src its Source, and pass 1
+# records where pass 2 has to insert output in:
+#   ixpos, the offset after each ix comment, an array as there may be
+#     millions, or SpilledPositions, their targets are numbered on from
+#     first
+#   heres, a list of (number of ix before it, offset of the line start,
+#     target, selargs, attrs) for each ixhere comment
+# outname is the name of its output for links from other documents.
+class Document:
+    def __init__(self, stream, src, first, outname=None, ixpos=None):
+        self.stream = stream; self.src = src; self.first = first
+        if ixpos is None: ixpos = array.array('l')
+        self.ixpos = ixpos; self.heres = []
+        self.outname = outname
+    def marks(self):
+        """The marks in document order, ('ix', offset, rno) and
+           ('ixhere', offset, target, selargs, attrs)"""
+        ixpos = self.ixpos; first = self.first; i = 0
+        for h in self.heres:
+            while i < h[0]:
+                yield ('ix', ixpos[i], first + i); i += 1
+            yield ('ixhere',) + h[1:]
+        while i < len(ixpos):
+            yield ('ix', ixpos[i], first + i); i += 1
+    def close(self):
+        if self.src is not None: self.src.close()
+        self.src = None
+
+# A temporary file of records for an ExternalIndex, tuples whose last item
+# is their attrs, written as marshalled blocks of block_size records.  The
+# first record and the offset of each block are kept to find records.
+# Records are read a block at a time through a map of just that block,
+# which forked workers can share without a file position and which is not
+# left counted in the resident size, the last block read is kept.  The
+# records not yet in a full block are pending in memory.
+class Run(object):
+    block_size = 1024
+    def __init__(self, records=()):
+        import tempfile
+        self.f = tempfile.TemporaryFile()
+        self.offsets = [ 0 ]; self.firsts = []; self.pending = []
+        self.last = (None, None)
+        for r in records: self.append(r)
+        self.flush()
+    def append(self, r):
+        p = self.pending; p.append(r)
+        if len(p) >= self.block_size: self.flush()
+    def flush(self):
+        "Write the pending records as a block"
+        p = self.pending
+        if not p: return
+        # marshal needs the FrozenAttrs as plain dicts
+        data = marshal.dumps([ r[:-1] + (dict(r[-1]),) for r in p ])
+        self.f.seek(self.offsets[-1]); self.f.write(data); self.f.flush()
+        self.firsts.append(p[0]); self.offsets.append(self.offsets[-1] + len(data))
+        self.pending = []
+    def block(self, i):
+        "The records of block i"
+        if i == len(self.firsts): return self.pending
+        if self.last[0] == i: return self.last[1]
+        start = self.offsets[i]; skip = start % mmap.ALLOCATIONGRANULARITY
+        m = mmap.mmap(self.f.fileno(), self.offsets[i+1] - start + skip,
+                      offset=start - skip, access=mmap.ACCESS_READ)
+        try: b = marshal.loads(m[skip:])
+        finally: m.close()
+        self.last = (i, b)
+        return b
+    def __getitem__(self, i):
+        "Record number i, all blocks but the last are full"
+        return self.block(i // self.block_size)[i % self.block_size]
+    def find(self, key):
+        "The number of the block records from key on start in"
+        return max(0, bisect.bisect_right(self.firsts, key) - 1)
+    def records(self, block=0):
+        "Generate the records in order from block"
+        for i in xrange(block, len(self.firsts) + 1):
+            for r in self.block(i): yield r
+    def close(self):
+        self.f.close()
+
+# The index kept in temporary files instead of in memory, for --memory-
+# budget.  Pass 1 adds a record (target, terms, rno, text, attrs) for each
+# ix target to a buffer.  When the buffer reaches the budget, reckoning
+# record_size bytes a record, it is sorted and spilled as a Run.  Before
+# an index is output the runs are merged into one Run in (target, terms,
+# rno) order, the order of tree_entries(), where an index reads only its
+# part.  The (offset, text, attrs) of each target are also spilled, by
+# target number, for the anchors.
+class ExternalIndex(object):
+    record_size = 200
+    def __init__(self, budget):
+        self.limit = max(Run.block_size, budget // self.record_size)
+        self.buffer = []; self.runs = []; self.targets = set()
+        self.spill = Run()
+    def add(self, target, terms, rno, pos, text, attrs):
+        self.spill.append((pos, text, attrs))
+        self.buffer.append((target, terms, rno, text, attrs))
+        self.targets.add(target)
+        if len(self.buffer) >= self.limit: self.sort_run()
+    def target(self, rno):
+        "The (text, attrs) of target number rno"
+        pos, text, attrs = self.spill[rno]
+        return text, attrs
+    def sort_run(self):
+        "Spill the buffer as a sorted run"
+        if not self.buffer: return
+        self.buffer.sort()
+        self.runs.append(Run(self.buffer)); self.buffer = []
+        log.debug("Spilled run %d", len(self.runs))
+    def merged(self):
+        "The Run of all the records added, merging the runs if need be"
+        self.sort_run()
+        if len(self.runs) > 1:
+            import heapq
+            runs = self.runs
+            log.debug("Merging %d runs", len(runs))
+            self.runs = [ Run(heapq.merge(*[ r.records() for r in runs ])) ]
+            for r in runs: r.close()
+        return self.runs[0] if self.runs else None
+    def records(self, target, selargs):
+        "Generate the records of target whose terms start with selargs"
+        run = self.merged()
+        if run is None: return
+        key = (target, selargs); n = len(selargs)
+        for r in run.records(run.find(key)):
+            if r[0] != target or r[1][:n] != selargs:
+                if r[:2] < key: continue
+                break
+            yield r
+    def close(self):
+        for r in self.runs: r.close()
+        self.spill.close()
+        self.runs = []; self.buffer = []
+
+# The ixpos of a Document scanned into an ExternalIndex, n positions kept
+# in its spill from target number first
+class SpilledPositions(object):
+    def __init__(self, spill, first):
+        self.spill = spill; self.first = first; self.n = 0
+    def __len__(self):
+        return self.n
+    def __getitem__(self, i):
+        return self.spill[self.first + i][0]
+
+# Phase timings and counters for --stats, kept by an Indexer given one.
+# A phase may be entered many times, its time is the total and its growth
+# the most the peak resident size of the process grew during any.  A phase
+# that runs after another reached a higher peak shows no growth, so the
+# growth is memory the phase needed beyond what earlier ones did.  Stats is
+# also gives a logging handler that added to the flexndex logger counts
+# the warnings.
+class Stats(object):
+    # phases in report order, indented ones are parts of the one before
+    phases = [ 'config parse', 'style load', 'pass 1', 'pass 2', 'stream',
+               '  sort/complete', '  collimate', '  render', '  anchors' ]
+    def __init__(self):
+        self.times = {}; self.peaks = {}; self.counts = {}
+    @staticmethod
+    def peak():
+        "The peak resident size of the process so far in KiB"
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    @contextmanager
+    def phase(self, name):
+        "Context to time phase name"
+        t = time.time(); start = self.peak()
+        try: yield
+        finally: self.add(name, time.time() - t, start)
+    def add(self, name, secs, start=None):
+        """Add secs to the time of phase name, and if start, the peak() when
+           it began, note how much the peak grew"""
+        self.times[name] = self.times.get(name, 0.0) + secs
+        if start is not None:
+            self.peaks[name] = max(self.peaks.get(name, 0), self.peak() - start)
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+    def handler(self):
+        "A logging handler counting the warnings and errors in these stats"
+        import logging
+        stats = self
+        class Counter(logging.Handler):
+            def emit(self, record): stats.count('warnings')
+        return Counter(logging.WARNING)
+    def report(self, f):
+        f.write('%-18s %10s %10s\n' % ('phase', 'seconds', 'peak +MiB'))
+        for p in self.phases:
+            name = p.strip()
+            if name not in self.times: continue
+            peak = self.peaks.get(name)
+            f.write('%-18s %10.3f %10s\n' % (p, self.times[name],
+                '%.1f' % (peak / 1024.0) if peak is not None else '-'))
+        for name in sorted(self.counts):
+            f.write('%-18s %10d\n' % (name, self.counts[name]))
+
+# Index generator
+#
+# An Indexer owns the configuration, the styles built from it, an AttrCache
+# of the attrlists parsed and the index of the documents scanned by it.
+# The styles are not changed once built so copy() gives an Indexer sharing
+# them and the AttrCache with an empty index, eg for each document or
+# thread, without parsing the configuration again.  Calls on
+# one Indexer from several threads are serialised by its lock.
+#
+#   ix = Indexer('docbook', ['my.conf'])
+#   ix.scan('in.xml')                  # pass 1, for each document
+#   ix.render('in.xml', 'out.xml')     # pass 2, for each document
+#   ix.copy().process(f, o)            # both for one document
+#
+# Streams and outputs may be file objects or paths.  If stats, a Stats, is
+# given the phases and counts of the work are added to it.  The parsed
+# configuration and built styles are kept in cache, a Cache, and in
+# style_cache, a StyleCache, if given.  If memory_budget is given the index
+# is kept in an ExternalIndex using about that many bytes of memory.  If
+# used_anchors the anchors of targets no ixhere lists are not output.
+class Indexer:
+    def __init__(self, backend='xhtml11', configs=(), spool_size=64<<20,
+                 cache=None, write_buffer=1<<20, direct=False, stats=None,
+                 style_cache=None, memory_budget=None, used_anchors=False):
+        self.backend = backend_aliases.get(backend, backend)
+        self.memory_budget = memory_budget; self.used_anchors = used_anchors
+        self.spool_size = spool_size
+        self.write_buffer = write_buffer; self.direct = direct
+        self.cache = cache; self.stats = stats
+        self.attributes = dict(predefined_attributes)
+        if self.backend not in anchors:
+            log.warning("Warning: no anchor for backend %s", self.backend)
+        self.anchor = Template(anchors.get(self.backend, ''))
+        # anchors substituting only the target number, as the builtin ones
+        # do, are output by formatting, others are rendered
+        self.anchor_format = self.anchor.format(('ixtgt',))
+        # TODO attributes anchors and default style from config
+        # the files are read now, but only parsed when a style is needed
+        confs = [ styles_config ]
+        for f in configs:
+            with open(f,'r') as fo:
+                confs.append(fo.read())
+        cached = (None, None)
+        caches = [ c for c in (cache, style_cache) if c is not None ]
+        if caches:
+            import hashlib
+            digest = hashlib.md5(marshal.dumps((self.backend, confs))).digest()
+            for c in caches: cached = c.set_config(digest) or cached
+        self.styles = Styles(confs, cached[0], cached[1], self.phase)
+        for c in caches: c.styles = self.styles
+        # the parsed attrlists, shared by the copies like the styles
+        self.attrs = AttrCache()
+        self.lock = thread.allocate_lock()
+        self.clear()
+
+    def clear(self):
+        # the index, the text and attrs of each target by number and the
+        # distinct attrs so equal ones are shared
+        self.inds = {}; self.docs = []; self.file_starts = []; self.rno = 0
+        self.texts = []; self.tattrs = []; self.attrsets = {}
+        # the flags of the targets listed by an ixhere, made when needed
+        self.used = None
+        # or all in temporary files
+        self.external = None
+        if self.memory_budget: self.external = ExternalIndex(self.memory_budget)
+
+    def copy(self, cache=None):
+        """Return an Indexer with the same configuration and an empty index,
+           with the Cache cache if given"""
+        import copy
+        ix = copy.copy(self)
+        ix.lock = thread.allocate_lock(); ix.cache = cache
+        if cache is not None: cache.styles = self.styles
+        ix.clear()
+        return ix
+
+    def reset(self):
+        "Empty the index, closing the documents scanned"
+        with self.lock:
+            for doc in self.docs: doc.close()
+            if self.external is not None: self.external.close()
+            self.clear()
+
+    def phase(self, name):
+        "Context timing phase name in the stats, if kept"
+        if self.stats is None: return no_phase
+        return self.stats.phase(name)
+
+    def subout(self, o, template, *dicts, **kwargs):
+        """Output to file o after substituting attributes in template
+           print warning if key not found and leave in output
+           kwargs for subs values are searched first, then the mapping
+           objects in dicts left to right, then the attributes"""
+        o.write(template.render(dicts + (self.attributes,), kwargs))
+        if self.stats is not None: self.stats.count('template renders')
+
+    def add(self, stream, src, parts, outname=None):
+        """Pass 1 for a document, parts is the scan_parts() of it, adds its
+           ix targets to the index, numbering them on from the last
+           document, and returns the Document"""
+        log.debug("Pass 1")
+        ic = 0; cache = self.cache; fno = len(self.docs)
+        self.file_starts.append(self.rno)
+        doc = Document(stream, src, self.rno, outname, self.positions(self.rno))
+        self.used = None
+        for start, digest, markers in parts:
+            if cache is not None:
+                markers = cache.chunk(digest, markers, self.rno, fno)
+            ic += self.add_markers(markers, start, doc, fno)
+        self.docs.append(doc)
+        log.info('Pass 1 found %d ix entries', ic)
+        return doc
+
+    def positions(self, first):
+        "The ixpos for a Document whose targets are numbered from first"
+        if self.external is None: return array.array('l')
+        return SpilledPositions(self.external.spill, first)
+
+    def add_markers(self, markers, start, doc, fno):
+        """Add the ix targets of the scan() markers of a chunk at offset
+           start to the index and record them in doc, returns the number
+           of targets"""
+        ic = 0; rno = self.rno; inds = self.inds; attrsets = self.attrsets
+        texts = self.texts; tattrs = self.tattrs; ixpos = doc.ixpos
+        external = self.external
+        debug = log.isEnabledFor(DEBUG)
+        for m in markers:
+            if m[0] == 'ixhere':
+                if debug: log.debug('Found ixhere %s in file %d', m[2], fno)
+                doc.heres.append((len(ixpos), start + m[1]) + m[2:])
+                continue
+            ic += 1
+            kind, pos, tgt, a, d = m
+            if debug: log.debug('Found ix %s %s in file %d', tgt, a, fno)
+            if external is not None:
+                external.add(tgt, a, rno, start + pos, d.get('text', a[-1]), d)
+                ixpos.n += 1; rno += 1
+                continue
+            if d is not empty_attrs:
+                d = attrsets.setdefault(tuple(sorted(d.items())), d)
+            if tgt not in inds: inds[tgt] = TermNode()
+            inds[tgt].add(a, rno)
+            texts.append(d.get('text', a[-1])); tattrs.append(d)
+            ixpos.append(start + pos)
+            rno += 1
+        if self.stats is not None:
+            self.stats.count('ix markers', ic)
+            self.stats.count('ixhere markers', len(markers) - ic)
+        self.rno = rno
+        return ic
+
+    def scan(self, stream, outname=None):
+        """Pass 1, add the document read from stream to the index, outname
+           is the name of its output for links from other documents"""
+        with self.lock, self.phase('pass 1'):
+            src = Source(stream, self.spool_size)
+            known = None
+            if self.cache is not None: known = self.cache.known()
+            return self.add(stream, src, scan_parts(src.buf, known, attrs=self.attrs), outname)
+
+    def document(self, stream):
+        "The Document scanned from stream"
+        for doc in self.docs:
+            if doc is stream or doc.stream is stream or doc.stream == stream:
+                return doc
+        raise ValueError('document not scanned')
+
+    def render(self, stream, out, jobs=1):
+        """Pass 2, write the document scanned from stream with its indexes to
+           out, the indexes are made by jobs worker processes if more than 1"""
+        with self.lock:
+            doc = self.document(stream)
+            if isinstance(out, basestring) and doc.outname is None:
+                doc.outname = out
+            blocks = None
+            if jobs > 1 and len(doc.heres) > 1:
+                with self.phase('pass 2'): blocks = self.index_blocks(doc, jobs)
+            if isinstance(out, basestring):
+                with open(out, 'wb') as o:
+                    self.write(doc, o, blocks)
             else:
-                if len(entries[b][0]) <= blevel: c = b
-        if args.verbose > 2: print "c=",c
-        counts[i] = c
-    # get increments and style pairs dependent on id
-    id = mo.group('id')
-    if id == 'lc':
-        prev = 0; count_pairs = []
-        for i in counts:
-            count_pairs.append((prev, i-1))
-            prev = i
-        estyles = zip(styleob.row_starts, styleob.row_ends)
-        cstyles = zip(styleob.col_starts, styleob.col_ends)
-    elif id == 'lr':
-        pass
-    elif id == 'ic':
-        pass
-    elif id == 'ir':
-        pass
-    if args.verbose > 2:
-        print "    Column lengths", count_pairs
-        print "    Entry Styles", estyles
-        print "    Count styles", cstyles
-    return [entries, count_pairs, estyles, cstyles]
-    
-def pass2():
-    if args.verbose > 1 : print "Pass 2"
-    ic = 0; hc = 0
-    with open(args.infile, 'r') as f, open(args.outfile,'w') as o:
-        rno = 0; lno = 0
-        for line in f:
-            lno += 1
-            m = ixhere_re.search(line)
-            if m is not None:
-                if args.verbose > 1 : print 'Found ixhere in: ', line,
+                self.write(doc, out, blocks)
+
+    def process(self, stream, out):
+        "Scan and render a document, closing it after"
+        doc = self.scan(stream, out if isinstance(out, basestring) else None)
+        try: self.render(doc, out)
+        finally: doc.close()
+
+    def close(self):
+        "Close the documents scanned, the index is kept"
+        with self.lock:
+            for doc in self.docs: doc.close()
+
+    def file_links(self, doc):
+        "Links from the output of doc to each document's output for {ixfile}"
+        if len(self.docs) == 1: return ['']
+        # an output without a name is taken to be in the current directory
+        if doc.outname is None: here = os.getcwd()
+        else: here = os.path.dirname(os.path.abspath(doc.outname))
+        links = []
+        for d in self.docs:
+            if d is doc or d.outname is None: links.append('')
+            else: links.append(os.path.relpath(os.path.abspath(d.outname),
+                                               here).replace(os.sep, '/'))
+        return links
+
+    def file_link(self, links, rn):
+        "The link to the document containing target number rn"
+        if len(links) == 1: return links[0]
+        return links[bisect.bisect_right(self.file_starts, rn) - 1]
+
+    def writer(self, f):
+        "The OutputWriter for output to f"
+        return OutputWriter(f, self.write_buffer, self.direct)
+
+    def write(self, doc, f, blocks=None):
+        """Pass 2 of doc to file f, blocks is the output of its indexes in
+           order if already made, None for any to be made"""
+        with self.phase('pass 2'): self.write_doc(doc, f, blocks)
+
+    @contextmanager
+    def forking(self):
+        """Context holding the locks this Indexer shares with its copies and
+           the logging locks while worker processes are forked, so no other
+           thread holds one at the fork, the workers replace them by
+           forked()"""
+        logging = sys.modules.get('logging')
+        locks = [ self.styles.lock, self.attrs.lock ]
+        locks.extend(h.lock for h in log_handlers() if h.lock is not None)
+        for l in locks: l.acquire()
+        if logging is not None: logging._acquireLock()
+        try: yield
+        finally:
+            if logging is not None: logging._releaseLock()
+            for l in reversed(locks): l.release()
+
+    def index_blocks(self, doc, jobs):
+        """The output of the indexes of doc made in parallel by jobs worker
+           processes, in document order, None for those cached"""
+        import multiprocessing
+        if doc.src is None: doc.src = Source(doc.stream, self.spool_size)
+        # the workers share the merged external index
+        if self.external is not None: self.external.merged()
+        cache = self.cache; fno = self.docs.index(doc)
+        links = self.file_links(doc)
+        blocks = [ None ] * len(doc.heres); todo = []
+        for i, h in enumerate(doc.heres):
+            if cache is None or not cache.has_block(
+                    cache.block_key(h[2], h[3], h[4], links)):
+                todo.append((fno, i))
+        if not todo: return blocks
+        # larger indexes first so they do not finish last
+        todo.sort(key=lambda t: -self.index_size(*doc.heres[t[1]][2:4]))
+        with self.forking():
+            pool = multiprocessing.Pool(min(jobs, len(todo)), render_init, (self,))
+        try:
+            for (f, i), b in zip(todo, pool.map(render_index, todo, 1)):
+                blocks[i] = b
+        finally:
+            pool.close(); pool.join()
+        return blocks
+
+    def index_size(self, target, selargs):
+        "Estimate of the number of entries of the index of target from selargs"
+        if self.external is not None: return 0
+        node = self.inds.get(target)
+        if node is not None: node = node.find(selargs)
+        if node is None: return 0
+        return node.count()
+
+    def write_doc(self, doc, f, blocks=None):
+        log.debug("Pass 2")
+        ic = 0; hc = 0; cache = self.cache; stats = self.stats
+        if doc.src is None: doc.src = Source(doc.stream, self.spool_size)
+        src = doc.src
+        links = self.file_links(doc)
+        used = self.used_targets() if self.used_anchors else None
+        upto = 0; o = self.writer(f)
+        for mark in doc.marks():
+            src.write(o, upto, mark[1])
+            upto = mark[1]
+            if mark[0] == 'ix':
+                ic += 1
+                if used is not None and not used[mark[2]]:
+                    if stats is not None: stats.count('anchors skipped')
+                elif stats is None: self.anchor_out(o, mark[2])
+                else:
+                    t = time.time(); self.anchor_out(o, mark[2])
+                    stats.add('anchors', time.time() - t)
+            else:
+                kind, pos, target, selargs, hereattrs = mark
+                made = blocks[hc] if blocks is not None else None
                 hc += 1
-                # decode the ixhere comment and attributes
-                hereindex = inds.get(m.group('target'), {})
-                selargs, hereattrs = attr_tuple(m.group('attrlist'))
-                style = hereattrs.get('style', default_style)
-                if style not in styles :
-                    print 'Warning: index style', style,
-                    print "not found, using default, at line ", lno
-                    style = default_style
-                styleob = styles[style].get(args.backend)
-                if styleob is None:
-                    print "Warning: backend", args.backend,
-                    print "not found for style", style, ", index omitted",
-                    print "at line", lno
+                if cache is None:
+                    if made is not None: o.write(made)
+                    else: self.index_out(o, target, selargs, hereattrs, LineNo(src, pos), links)
                     continue
-                subout(o, styleob.prefix, hereattrs )
-                #get terms
-                terms = hereindex.keys()
-                if args.verbose > 2 : print 'Terms in index', terms
-                if len(terms) == 0:
-                    subout(o, styleob.empty_message, hereattrs)
+                key = cache.block_key(target, selargs, hereattrs, links)
+                block = cache.block(key)
+                if block is None:
+                    if made is None:
+                        bo = Block()
+                        self.index_block(bo, target, selargs, hereattrs, LineNo(src, pos), links)
+                        made = ''.join(bo)
+                    block = cache.blocks[key] = made
+                o.write(block)
+        src.write(o, upto)
+        o.flush()
+        log.info('Pass 2 found %d ix entries %d ixhere entries', ic, hc)
+
+    def anchor_out(self, o, rno):
+        "Output the anchor of target number rno"
+        if self.anchor_format is not None:
+            o.write(self.anchor_format % { 'ixtgt' : rno })
+            return
+        if self.external is None:
+            text = self.texts[rno]; attrs = self.tattrs[rno]
+        else: text, attrs = self.external.target(rno)
+        self.subout(o, self.anchor, attrs, ixtext=text, ixtgt=str(rno))
+
+    def used_targets(self):
+        """A bytearray flagging by number the targets in the index of some
+           ixhere of the documents scanned, those whose target matches and
+           whose terms start with its selargs"""
+        if self.used is not None: return self.used
+        used = bytearray(self.rno); done = set()
+        for doc in self.docs:
+            for h in doc.heres:
+                key = h[2:4]
+                if key in done: continue
+                done.add(key)
+                if self.external is not None:
+                    for r in self.external.records(*key): used[r[2]] = 1
                     continue
-                # select only terms matching the arguments
-                if len(selargs) > 0:
-                    terms = [ x for x in terms if x[0:len(selargs)] == selargs ]
-                if 'sort' in hereattrs :
-                    mo = sort_levels_re.search(hereattrs['sort'])
-                    if mo:
-                        minl, maxl = mo.groups()
-                        if maxl: maxl = int(maxl)
-                        else: maxl = -2
-                        if minl: minl = int(minl)-1
-                        else: minl = 0
-                        terms.sort(key=lambda e: e[minl:maxl+1])
-                    else : print "Unknown sort option", hereattrs['sort']
-                else: terms.sort()
-                # generate missing entries if needed
-                if styleob.complete.startswith('e') or styleob.complete.startswith('t'):
-                    entries = []; lastentry = []
-                    for entry in terms:
-                        pref_len = len(shared_prefix(entry, lastentry))
-                        while pref_len+1 < len(entry):
-                            entries.insert(0, [entry[:pref_len+1], {}, False])
-                            pref_len += 1
-                        if styleob.complete.startswith('t') and len(hereindex[entry]) > 1:
-                            for t in hereindex[entry].items():
-                                entries.insert(0, [list(entry), {t[0] : t[1]}, True])
-                        else:
-                            entries.insert(0, [list(entry), hereindex[entry], False])
-                        lastentry = entry
-                    entries.reverse()
+                node = self.inds.get(key[0])
+                if node is not None: node = node.find(key[1])
+                stack = [ node ] if node is not None else []
+                while stack:
+                    node = stack.pop()
+                    for rn in node.targets(): used[rn] = 1
+                    if node.children: stack.extend(node.children.itervalues())
+        self.used = used
+        return used
+
+    def index_out(self, o, target, selargs, hereattrs, lno, links=['']):
+        "Output the index for an ixhere to o in one write"
+        b = Block()
+        self.index_block(b, target, selargs, hereattrs, lno, links)
+        o.write(''.join(b))
+
+    def index_block(self, o, target, selargs, hereattrs, lno, links=['']):
+        "Output the index for an ixhere to o, timing the render phase"
+        stats = self.stats
+        if stats is None:
+            return self.make_index(o, target, selargs, hereattrs, lno, links)
+        t = time.time(); start = stats.peak()
+        parts = lambda: (stats.times.get('sort/complete', 0.0) +
+                         stats.times.get('collimate', 0.0))
+        before = parts()
+        self.make_index(o, target, selargs, hereattrs, lno, links)
+        stats.add('render', time.time() - t - (parts() - before), start)
+        stats.count('indexes')
+
+    def make_index(self, o, target, selargs, hereattrs, lno, links):
+        external = self.external
+        if external is None:
+            hereindex = self.inds.get(target, TermNode())
+            empty = not hereindex.children and hereindex.rnos is None
+        else: empty = target not in external.targets
+        style = hereattrs.get('style', default_style)
+        if not self.styles.has(style):
+            log.warning("Warning: index style %s not found, using default, at line %s",
+                        style, lno)
+            style = default_style
+        styleob = self.styles.get(style, self.backend)
+        if styleob is None:
+            log.warning("Warning: backend %s not found for style %s, index omitted at line %s",
+                        self.backend, style, lno)
+            return
+        self.subout(o, styleob.prefix, hereattrs )
+        if empty:
+            self.subout(o, styleob.empty_message, hereattrs)
+            return
+        # levels to output
+        if 'levels' in hereattrs:
+            minl, maxl = levels_re.match(hereattrs['levels']).groups()
+            if maxl: maxl = int(maxl)
+            else: maxl = 1000
+            if minl: minl = int(minl)-1
+            else: minl = 0
+        else:
+            minl = 0; maxl = 1000
+        complete = styleob.complete[:1]
+        if complete not in ('e', 't'): complete = ''
+        # select, sort and generate the entries
+        texts = self.texts; tattrs = self.tattrs
+        with self.phase('sort/complete'):
+            sort = None
+            if 'sort' in hereattrs :
+                mo = sort_levels_re.search(hereattrs['sort'])
+                if mo:
+                    sminl, smaxl = mo.groups()
+                    if smaxl: smaxl = int(smaxl)
+                    else: smaxl = -2
+                    if sminl: sminl = int(sminl)-1
+                    else: sminl = 0
+                    sort = (sminl, smaxl)
+                else :
+                    log.warning("Unknown sort option %s", hereattrs['sort'])
+            # entries of an external index not collimated or sorted are
+            # generated as they are output
+            stream = external is not None and sort is None and 'cols' not in hereattrs
+            if external is not None:
+                texts = {}; tattrs = {}
+                items = self.external_items(target, selargs, texts, tattrs, stream)
+                if sort is not None:
+                    items = sorted(items, key=lambda e: e[0][sort[0]:sort[1]+1])
+                entries = list_entries(items, complete, minl, maxl)
+            elif sort is not None:
+                node = hereindex.find(selargs)
+                if node is None: items = []
+                else: items = node.sorted_items(list(selargs), sort[0], sort[1])
+                entries = list_entries(items, complete, minl, maxl)
+            else:
+                entries = tree_entries(hereindex, selargs, complete, minl, maxl)
+            # entries deeper than the style cannot be output
+            entries = shown_entries(entries, len(styleob.levels))
+            if not stream: entries = list(entries)
+        if log.isEnabledFor(TRACE) and not stream:
+            log.log(TRACE, 'Entries in index %s', entries)
+        # collimate
+        with self.phase('collimate'):
+            layout = collimate(entries, hereattrs, styleob, lno)
+        if layout is None: return
+        groups, gstarts, gends, estarts, eends = layout
+        # set indents
+        indent = int(hereattrs.get('indents', '0'))
+        # iterate through the groups of entries
+        for group_no, group in enumerate(groups):
+            self.subout(o, gstarts[group_no % len(gstarts)], hereattrs)
+            for entry_no, e in enumerate(group):
+                self.subout(o, estarts[entry_no % len(estarts)], hereattrs)
+                if e is not None:
+                    self.entry_out(o, e, styleob, hereattrs, minl, indent, links,
+                                   texts, tattrs)
+                self.subout(o, eends[entry_no % len(eends)], hereattrs)
+            self.subout(o, gends[group_no % len(gends)], hereattrs)
+        self.subout(o, styleob.postfix, hereattrs)
+
+    def external_items(self, target, selargs, texts, tattrs, stream):
+        """Generate the (terms, targets) of the index of target selecting
+           selargs from the external index in tree order, setting the text
+           and attrs of their targets by number in texts and tattrs.  If
+           stream only those of the last item generated are kept."""
+        terms = None; targets = []
+        for r in self.external.records(target, selargs):
+            if r[1] != terms:
+                if targets: yield terms, targets
+                if stream: texts.clear(); tattrs.clear()
+                terms = r[1]; targets = []
+            rno = r[2]; targets.append(rno)
+            texts[rno] = r[3]; tattrs[rno] = r[4]
+        if targets: yield terms, targets
+
+    def entry_out(self, o, e, styleob, hereattrs, minl, indent, links, texts, tattrs):
+        """Output the levels of entry e from minl, texts and tattrs give the
+           text and attrs of its targets by number"""
+        entry = e.terms; tgt = e.targets
+        # output internal levels from minimum
+        level_no = 0
+        for term, tstyle in zip(entry[minl:-1], styleob.levels):
+            self.subout(o, tstyle.text_internal, hereattrs, ixterm=term, ixindent=str(level_no * indent))
+            level_no += 1
+        # output the last level as link or multi target
+        indent_no = str(indent * level_no)
+        tstyle = styleob.levels[len(entry)-1]
+        lt = len(tgt)
+        if lt == 1 and not e.multi:
+            # single target, make the last term text a link
+            rn = tgt[0]
+            self.subout(o, tstyle.link_last, tattrs[rn], hereattrs,
+                ixterm=entry[-1], ixtgt=str(rn), ixtext=texts[rn], ixindent=indent_no,
+                ixfile=self.file_link(links, rn))
+        else:
+            # no target, output last term as text
+            self.subout(o, tstyle.text_last, hereattrs, ixterm=entry[-1], ixindent=indent_no)
+        if lt > 1 or e.multi:
+            # multiple targets, iterate through the multi targets
+            for rn in tgt:
+                self.subout(o, tstyle.multi_target, tattrs[rn], hereattrs,
+                    ixterm = entry[-1], ixtgt=str(rn), ixtext=texts[rn], ixindent=indent_no,
+                    ixfile=self.file_link(links, rn))
+
+    def stream(self, instream, out, bsize=1<<16):
+        """Index a single document read from instream a block of lines at a
+           time.  Output before the first ixhere is written to out as soon
+           as it is read, the rest is held in a spool, on disk past
+           spool_size, until the end of the input when the indexes can be
+           made.  Only the spool offsets of the indexes are kept.  instream
+           may be a path, eg of a pipe."""
+        if isinstance(instream, basestring):
+            with open(instream, 'rb') as f: return self.stream(f, out, bsize)
+        with self.lock, self.phase('stream'):
+            log.debug("Streaming")
+            fno = len(self.docs); self.file_starts.append(self.rno)
+            doc = Document(instream, None, self.rno, None)
+            self.docs.append(doc)
+            import tempfile, shutil
+            ic = 0; hc = 0; lno = 1; rest = ''
+            o = w = self.writer(out)
+            spool = None; holes = []
+            # read what has arrived rather than waiting for a whole block,
+            # so output is not held back by a slow pipe
+            try: fd = instream.fileno()
+            except (AttributeError, IOError, ValueError): fd = None
+            while True:
+                if fd is None: data = instream.read(bsize)
+                else: data = os.read(fd, bsize)
+                block = rest + data; rest = ''
+                if data:
+                    nl = block.rfind('\n') + 1
+                    if nl == 0:
+                        rest = block; continue
+                    block, rest = block[:nl], block[nl:]
+                elif not block: break
+                # only the marks of the block are kept
+                doc.first = self.rno; doc.ixpos = self.positions(self.rno)
+                del doc.heres[:]
+                ic += self.add_markers(scan(block, 0, len(block), self.attrs), 0, doc, fno)
+                upto = 0
+                for mark in doc.marks():
+                    o.write(buffer(block, upto, mark[1] - upto))
+                    upto = mark[1]
+                    if mark[0] == 'ix':
+                        self.anchor_out(o, mark[2])
+                    else:
+                        if spool is None:
+                            o = spool = tempfile.SpooledTemporaryFile(self.spool_size)
+                        hc += 1
+                        holes.append((spool.tell(), lno + block.count('\n', 0, upto)) + mark[2:])
+                o.write(buffer(block, upto))
+                if spool is None:
+                    w.flush()
+                    if hasattr(out, 'flush'): out.flush()
+                lno += block.count('\n')
+                if not data: break
+            if spool is not None:
+                spool.seek(0); upto = 0
+                for hole in holes:
+                    copy_bytes(spool, w, hole[0] - upto)
+                    upto = hole[0]
+                    self.index_out(w, hole[2], hole[3], hole[4], hole[1])
+                shutil.copyfileobj(spool, w)
+                spool.close()
+                w.flush()
+            log.info('Found %d ix entries %d ixhere entries', ic, hc)
+
+    def index_files(self, pairs, jobs=1):
+        """Index the list of (infile, outfile) pairs together, with jobs
+           worker processes if more than one and the inputs are files and
+           the outputs paths, for a single file they make its indexes.  A
+           single input that exists but is not a regular file is
+           streamed."""
+        infiles = [ i for i, o in pairs ]
+        i = infiles[0]
+        if (len(pairs) == 1 and not is_file(i)
+                and not (isinstance(i, basestring) and not os.path.exists(i))):
+            o = pairs[0][1]
+            # the input is opened first so a failure leaves the output alone
+            if isinstance(i, basestring): i = open(i, 'rb')
+            try:
+                if isinstance(o, basestring):
+                    with open(o, 'wb') as f: self.stream(i, f)
+                else: self.stream(i, o)
+            finally:
+                if i is not infiles[0]: i.close()
+        elif (jobs > 1 and len(pairs) > 1 and all(map(is_file, infiles))
+              and all(isinstance(o, basestring) for i, o in pairs)):
+            import multiprocessing
+            known = None
+            if self.cache is not None: known = self.cache.known()
+            with self.phase('pass 1'):
+                state = (self.spool_size, known, self.attrs)
+                with self.forking():
+                    pool = multiprocessing.Pool(jobs, scan_init,
+                                                (state, self.styles))
+                for (i, o), parts in zip(pairs, pool.map(scan_file, infiles)):
+                    self.add(i, None, parts, o)
+                pool.close(); pool.join()
+            with self.phase('pass 2'):
+                # the workers share the merged external index and used targets
+                if self.external is not None: self.external.merged()
+                if self.used_anchors: self.used_targets()
+                with self.forking():
+                    pool = multiprocessing.Pool(jobs, render_init, (self,))
+                for r in pool.map(render_file, range(len(pairs))):
+                    if r is not None:
+                        self.cache.blocks.update(r[0])
+                        self.cache.block_hits += r[1]; self.cache.block_uses += r[2]
+                pool.close(); pool.join()
+        else:
+            try:
+                for i, o in pairs:
+                    self.scan(i, o if isinstance(o, basestring) else None)
+                for i, o in pairs: self.render(i, o, jobs)
+            finally:
+                self.close()
+
+# Process pool workers, the state is passed to the initializer so a forked
+# worker shares it rather than having it pickled.  Each worker process
+# keeps it in _worker.
+
+_worker = None
+
+def log_handlers():
+    "The handlers a record logged to log passes through"
+    if 'logging' not in sys.modules: return []
+    logger = log.get(); handlers = []
+    while logger is not None:
+        handlers.extend(logger.handlers)
+        logger = logger.parent if logger.propagate else None
+    return handlers
+
+def forked(styles, attrs):
+    "In a worker forked in Indexer.forking(), replace the locks it held"
+    styles.lock = thread.allocate_lock(); attrs.lock = thread.allocate_lock()
+    for h in log_handlers(): h.createLock()
+    if 'logging' in sys.modules:
+        import logging, threading
+        logging._lock = threading.RLock()
+
+def scan_init(state, styles):
+    global _worker
+    _worker = state
+    forked(styles, state[2])
+
+def scan_file(path):
+    spool_size, known, attrs = _worker
+    src = Source(path, spool_size)
+    try: return list(scan_parts(src.buf, known, attrs=attrs))
+    finally: src.close()
+
+def render_init(indexer):
+    global _worker
+    _worker = indexer
+    forked(indexer.styles, indexer.attrs)
+
+def render_index(task):
+    "The output of ixhere i of document fno, task is (fno, i)"
+    fno, i = task
+    doc = _worker.docs[fno]; h = doc.heres[i]
+    b = Block()
+    _worker.index_block(b, h[2], h[3], h[4], LineNo(doc.src, h[1]),
+                        _worker.file_links(doc))
+    return ''.join(b)
+
+def render_file(fno):
+    "Pass 2 of document fno, returns the index output cached and the hit counts"
+    doc = _worker.docs[fno]
+    try:
+        with open(doc.outname, 'wb') as o:
+            _worker.write(doc, o)
+    finally: doc.close()
+    cache = _worker.cache
+    if cache is None: return None
+    return cache.blocks, cache.block_hits, cache.block_uses
+
+# Index the (infile, outfile) pairs with indexer whenever an input
+# changes, checking every interval seconds, until interrupted.  The
+# indexer keeps its configuration and styles, and its cache, in memory
+# between runs, so a run only scans the chunks of input that changed and
+# only makes the indexes whose contents changed.
+def watch(indexer, pairs, jobs=1, interval=0.2):
+    def mtimes():
+        times = []
+        for i, o in pairs:
+            try: st = os.stat(i); times.append((st.st_mtime, st.st_size))
+            except OSError: times.append(None)
+        return times
+    cache = indexer.cache
+    seen = None
+    try:
+        while True:
+            now = mtimes()
+            if now != seen:
+                if seen is not None and cache is not None: cache.next_run()
+                seen = now; t = time.time()
+                try:
+                    indexer.reset()
+                    indexer.index_files(pairs, jobs)
+                except (IOError, OSError) as e:
+                    log.error("Error: %s", e)
                 else:
-                    entries = [ [list(x), hereindex[x], False] for x in terms ]
-                # filter out by levels
-                if 'levels' in hereattrs:
-                    minl, maxl = levels_re.match(hereattrs['levels']).groups()
-                    if maxl: maxl = int(maxl)
-                    else: maxl = 1000
-                    if minl: minl = int(minl)-1
-                    else: minl = 0
-                    entries = [ x for x in entries if len(x[0]) > minl and len(x[0]) <= maxl ]
+                    log.info("Indexed in %.1fms", (time.time() - t) * 1000)
+                if cache is not None:
+                    log.info('Cache reused %d of %d chunks %d of %d indexes',
+                             cache.chunk_hits, len(cache.chunks),
+                             cache.block_hits, cache.block_uses)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+# Indexing for --serve, an Indexer with an in memory Cache is kept for each
+# of the last size sets of (infile, outfile) pairs indexed, each copied
+# from indexer so the configuration is parsed and the styles built once.
+# Sets of files are indexed concurrently, each set one request at a time.
+# There are no worker processes, as forking while other threads hold locks
+# could leave them held in the workers.
+class IndexService(object):
+    size = 16
+    def __init__(self, indexer):
+        self.indexer = indexer
+        self.indexers = {}; self.order = []
+        self.lock = thread.allocate_lock()
+    def index(self, pairs):
+        "Index the list of (infile, outfile) pairs, returns the seconds taken"
+        for i, o in pairs:
+            if not is_file(i): raise IOError('%s is not a file' % i)
+        key = tuple(pairs)
+        with self.lock:
+            if key in self.indexers: self.order.remove(key)
+            else:
+                self.indexers[key] = (self.indexer.copy(Cache()), thread.allocate_lock())
+                if len(self.order) >= self.size:
+                    del self.indexers[self.order.pop()]
+            self.order.insert(0, key)
+            ix, lock = self.indexers[key]
+        with lock:
+            t = time.time()
+            ix.cache.next_run(); ix.reset()
+            ix.index_files(pairs)
+            return time.time() - t
+
+# Serve an IndexService on a Unix domain socket at path until interrupted.
+# The socket is only accessible to its owner, as clients name the files to
+# write.  Each line a client sends is a tab separated list of infile
+# outfile pairs, which are indexed together, the reply to each is a line
+# of "ok" and the milliseconds taken or of "error" and the message.
+# Connections are handled in threads.
+def serve(service, path):
+    import SocketServer
+    class Handler(SocketServer.StreamRequestHandler):
+        def handle(self):
+            for line in iter(self.rfile.readline, ''):
+                files = line.rstrip('\r\n').split('\t')
+                if len(files) % 2 or not files[0]:
+                    reply = 'error input and output files must be given in pairs'
                 else:
-                    minl = 0
-                # collimate
-                entries, counts, estyles, cstyles = collimate(entries, hereattrs, styleob, lno)
-                if entries is None: continue
-                elen = len(estyles); clen = len(cstyles)
-                # set indents
-                indent = int(hereattrs.get('indents', '0'))
-                # iterate through entries
-                count = 0; count_min, count_max = counts.pop(0)
-                count_no = 0; entry_no = 0;
-                for entry, tgt, mte in entries:
-                    if count == count_min:
-                        subout(o, cstyles[count_no][0], hereattrs)
-                    subout(o, estyles[entry_no][0], hereattrs )
-                    # output internal levels from minimum
-                    level_no = 0
-                    for term, tstyle in zip(entry[minl:-1], styleob.levels):
-                        subout(o, tstyle.text_internal, hereattrs, ixterm=term, ixindent=str(level_no * indent))
-                        level_no += 1
-                    # output the last level as link or multi target
-                    indent_no = str(indent * level_no)
-                    if len(entry) <= len(styleob.levels):
-                        tstyle = styleob.levels[len(entry)-1]
-                        lt = len(tgt)
-                        if lt == 1 and not mte:
-                            # single target, make the last term text a link
-                            rn, tgt_attrs = tgt.items()[0]
-                            txt = tgt_attrs.get('text', entry[-1])
-                            subout(o, tstyle.link_last, tgt_attrs, hereattrs,
-                                ixterm=entry[-1], ixtgt=rn, ixtext=txt, ixindent=indent_no)
-                        else:
-                            # no target, output last term as text
-                            subout(o, tstyle.text_last, hereattrs, ixterm=entry[-1], ixindent=indent_no)
-                        if lt > 1 or mte:
-                            # multiple targets, iterate through the multi targets
-                            for t in tgt.items():
-                                txt = t[1].get('text', entry[-1])
-                                subout(o, tstyle.multi_target, t[1], hereattrs,
-                                    ixterm = entry[-1], ixtgt=t[0], ixtext=txt, ixindent=indent_no)
-                        subout(o, estyles[entry_no][1], hereattrs)
-                        entry_no = (entry_no + 1) % elen
-                        if count == count_max:
-                            subout(o, cstyles[count_no][1], hereattrs)
-                            if len(counts) == 0: break
-                            count_min, count_max = counts.pop(0)
-                        count += 1
-                        count_no = (count_no + 1) % clen
-                    else:
-                        print "Warning, not enough style levels for target terms", entry
-                subout(o, styleob.postfix, hereattrs)
-            upto = 0
-            for m in ix_re.finditer(line):
-                if args.verbose > 1 : print 'Found ix in: ', line,
-                ic += 1
-                a, tgt_attrs = attr_tuple(m.group('attrlist'))
-                o.write(line[upto:m.end()])
-                upto = m.end()
-                text = tgt_attrs.get('text', a[-1])
-                subout(o, anchors[args.backend], tgt_attrs, ixtext=text, ixtgt=str(rno))
-                rno += 1
-            o.write( line[upto:] )
-    if args.verbose > 0: print 'Pass 2 found', ic, 'ix entries', hc, 'ixhere entries'
-
-def main():
-    global args
+                    try: t = service.index(zip(files[0::2], files[1::2]))
+                    except Exception as e:
+                        log.error("Error: %s", e)
+                        reply = 'error %s' % e
+                    else: reply = 'ok %.1f' % (t * 1000)
+                self.wfile.write(reply + '\n'); self.wfile.flush()
+    class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+        daemon_threads = True
+    if os.path.exists(path):
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            raise IOError('%s exists and is not a socket' % path)
+        os.remove(path)
+    # made with the umask so there is no time it is open to others
+    mask = os.umask(0177)
+    try: server = Server(path, Handler)
+    finally: os.umask(mask)
+    log.info("Serving on %s", path)
+    try: server.serve_forever()
+    except KeyboardInterrupt: pass
+    finally:
+        server.server_close(); os.remove(path)
+
+def main(argv=None):
+    import argparse
     p = argparse.ArgumentParser(description='Flexible index generator')
-    p.add_argument('infile', help='Input File')
-    p.add_argument('outfile', help='Output File')
-    p.add_argument('--verbose','-v', action='count')
+    p.add_argument('infile', nargs='?', default='-',
+                   help='Input File, - or omitted for standard input')
+    p.add_argument('outfile', nargs='?', default='-',
+                   help='Output File, - or omitted for standard output')
+    p.add_argument('more', nargs='*', metavar='infile outfile',
+                   help='More files indexed together with the first')
+    p.add_argument('--verbose','-v', action='count', default=0)
     p.add_argument('--backend', '-b', default='xhtml11')
-    p.add_argument('--config', '-c', action='append')
+    p.add_argument('--config', '-c', action='append', default=[])
+    p.add_argument('--cache',
+                   help='File to keep the index in between runs')
+    p.add_argument('--style-cache', metavar='FILE',
+                   help='File to keep the parsed configuration and styles in between runs')
+    p.add_argument('--memory-budget', type=int, metavar='BYTES',
+                   help='Keep the index in temporary files using about this much memory')
+    p.add_argument('--used-anchors', action='store_true',
+                   help='Only output the anchors of targets listed by some ixhere')
+    p.add_argument('--spool-size', type=int, default=64<<20,
+                   help='Bytes of unmappable input kept in memory before spooling to disk')
     p.add_argument('--version', action='version', version='flexndex.0.1alpha')
-    args = p.parse_args()
-    args.backend = backend_aliases.get(args.backend, args.backend)
-    conf_settings = Settings()
-    # TODO attributes anchors and default style from config
-    with closing(cStringIO.StringIO(styles_config)) as fo:
-        conf_settings.parse(fo)
-    if args.config:
-        for f in args.config:
-            with open(f,'r') as fo:
-                conf_settings.parse(fo)
-    if args.verbose >2: conf_settings.debug_print()
-    sts = conf_settings.get(('styles',))
-    for s in sts.keys():
-        if args.verbose > 1: print "Got style", s,
-        st = sts.get((s,))
-        for b in st.keys():
-            if args.verbose >1: print "backend", b,
-            if s not in styles: styles[s] = {}
-            styles[s][b] = Style(st.get((b,)))
-        if args.verbose > 1: print
-    pass1()
-#    print inds
-    pass2()
+    p.add_argument('--jobs', '-j', type=int, default=1,
+                   help='Worker processes for multiple files')
+    p.add_argument('--watch', action='store_true',
+                   help='Index the files again whenever an input changes')
+    p.add_argument('--interval', type=float, default=0.2,
+                   help='Seconds between checks for changes with --watch')
+    p.add_argument('--serve', metavar='SOCKET',
+                   help='Index the files named by clients connecting to the '
+                        'Unix domain socket SOCKET')
+    p.add_argument('--write-buffer', type=int, default=1<<20,
+                   help='Bytes of output collected before each write')
+    p.add_argument('--direct-write', action='store_true',
+                   help='Write output with os.write, bypassing file buffering')
+    p.add_argument('--stats', action='store_true',
+                   help='Print the time and peak memory of each phase and counts')
+    p.add_argument('--profile', metavar='FILE',
+                   help='Write a cProfile of the run to FILE')
+    args = p.parse_args(argv)
+    if len(args.more) % 2: p.error('input and output files must be given in pairs')
+    if args.watch and (args.infile == '-' or '-' in args.more[0::2]
+                       or not all(map(is_file, [ args.infile ] + args.more[0::2]))):
+        p.error('--watch needs input files')
+    if args.serve and args.jobs > 1: p.error('--serve cannot be used with --jobs')
+    pairs = []
+    for i, o in zip([ args.infile ] + args.more[0::2],
+                    [ args.outfile ] + args.more[1::2]):
+        if i == '-': i = sys.stdin
+        if o == '-': o = sys.stdout
+        pairs.append((i, o))
+    # messages go to standard error so they are never in the output
+    log.to_stderr([ WARNING, INFO, DEBUG ][args.verbose]
+                  if args.verbose < 3 else TRACE)
+    stats = None
+    if args.stats:
+        stats = Stats(); log.get().addHandler(stats.handler())
+    def run():
+        cache = None; style_cache = None
+        # the cache is not used when streaming, so it is not saved either
+        streamed = (not args.serve and not args.watch and len(pairs) == 1
+                    and not is_file(pairs[0][0]))
+        if args.cache and not streamed: cache = Cache(args.cache)
+        if args.style_cache: style_cache = StyleCache(args.style_cache)
+        if args.watch and cache is None: cache = Cache()
+        ix = Indexer(args.backend, args.config, args.spool_size, cache,
+                     args.write_buffer, args.direct_write, stats, style_cache,
+                     args.memory_budget, args.used_anchors)
+        if args.serve: serve(IndexService(ix), args.serve)
+        elif args.watch: watch(ix, pairs, args.jobs, args.interval)
+        else: ix.index_files(pairs, args.jobs)
+        if cache is not None: cache.save()
+        if style_cache is not None: style_cache.save()
+        if stats is not None:
+            stats.count('targets', ix.rno)
+            stats.count('attrlist cache hits', ix.attrs.hits)
+            stats.count('attrlist cache misses', ix.attrs.misses)
+            stats.count('index terms', sum(n.count() for n in ix.inds.values()))
+    if args.profile:
+        import cProfile
+        prof = cProfile.Profile()
+        try: prof.runcall(run)
+        finally: prof.dump_stats(args.profile)
+    else: run()
+    if stats is not None: stats.report(sys.stderr)
     return 0
 
 if __name__ == '__main__':
     main()
-
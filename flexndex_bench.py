@@ -0,0 +1,578 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Benchmarks for flexndex, see flexndex.py for the license.
+#
+#  python flexndex_bench.py [--suite SUITE] [--scales N,N,...] [--json FILE]
+#
+#  Each benchmark prints a line per result and adds it to the results
+#  written by --json, a dict of the python version, the date and the list
+#  of results, each a dict of the benchmark name, its parameters and the
+#  measurements, so runs can be compared.
+
+import argparse, time, random, cStringIO, sys, os, resource, subprocess
+import tempfile, json, platform, shutil, py_compile
+from contextlib import closing
+import flexndex
+
+# The per-call renderer flexndex used before templates were compiled,
+# kept here only as the baseline for comparison.
+def legacy_subout(o, sstr, *dicts, **kwargs):
+    def getkey(key):
+        s = kwargs.get(key)
+        if s is not None: return s
+        for d in dicts:
+            s = d.get(key)
+            if s is not None: return s
+        return flexndex.predefined_attributes.get(key)
+    bits = [ z.replace('{{','{').replace('}}', '}')
+             for z in flexndex.subs_re.split(sstr) ]
+    bits.append('{}')
+    for textbit, subsbit in zip(*[iter(bits)]*2):
+        o.write(textbit)
+        if subsbit != '{}':
+            cond = subsbit[1:-1].split('?', 1)
+            s = getkey(cond[0])
+            if len(cond) > 1:
+                if s is not None: o.write(s)
+                else: o.write(cond[1][1:])
+            else:
+                if s is not None: o.write(s)
+                else: o.write(subsbit)
+
+words = [ 'alpha', 'beta', 'gamma', 'delta', 'epsilon', 'zeta', 'eta',
+          'theta', 'iota', 'kappa', 'lambda', 'mu', 'nu', 'xi' ]
+
+# synthetic index of n entries, about a fifth with multiple targets
+def make_entries(n, seed=1):
+    r = random.Random(seed); entries = []; rno = 0
+    for i in range(n):
+        terms = [ r.choice(words) for l in range(r.randint(1, 3)) ]
+        terms[-1] += str(i)
+        tgts = {}
+        for t in range(1 if r.random() < 0.8 else r.randint(2, 4)):
+            tgts[str(rno)] = { 'text' : 'T%d' % rno } if t else {}
+            rno += 1
+        entries.append((terms, tgts))
+    return entries
+
+def load_style(name, backend='xhtml11'):
+    conf = flexndex.Settings()
+    with closing(cStringIO.StringIO(flexndex.styles_config)) as fo:
+        conf.parse(fo)
+    return conf.get(('styles', name, backend))
+
+# the template calls pass2 makes per entry, sub is the renderer
+def render(o, sub, levels, entries, hereattrs, field):
+    for entry, tgt in entries:
+        for lno, term in enumerate(entry[:-1]):
+            sub(o, field(levels[lno], 'text_internal'), hereattrs,
+                ixterm=term, ixindent=str(lno))
+        tstyle = levels[len(entry)-1]; indent = str(len(entry)-1)
+        if len(tgt) == 1:
+            rn, tgt_attrs = tgt.items()[0]
+            sub(o, field(tstyle, 'link_last'), tgt_attrs, hereattrs,
+                ixterm=entry[-1], ixtgt=rn,
+                ixtext=tgt_attrs.get('text', entry[-1]), ixindent=indent)
+        else:
+            sub(o, field(tstyle, 'text_last'), hereattrs,
+                ixterm=entry[-1], ixindent=indent)
+            for rn, tgt_attrs in tgt.items():
+                sub(o, field(tstyle, 'multi_target'), tgt_attrs, hereattrs,
+                    ixterm=entry[-1], ixtgt=rn,
+                    ixtext=tgt_attrs.get('text', entry[-1]), ixindent=indent)
+
+def timed(fn, *a):
+    t = time.time(); fn(*a); return time.time() - t
+
+def bench_templates(results, n, style):
+    entries = make_entries(n)
+    st = load_style(style)
+    levels = [ st.get(('levels', k)) for k in st.get(('levels',)).sorted_keys() ]
+    compiled = [ flexndex.Estyle(l) for l in levels ]
+    hereattrs = { 'text' : '', 'ixfile' : '' }
+    old = cStringIO.StringIO(); new = cStringIO.StringIO()
+    told = timed(render, old, legacy_subout, levels, entries, hereattrs,
+                 lambda l, f: l.get(f, ''))
+    tnew = timed(render, new, flexndex.Indexer().subout, compiled, entries,
+                 hereattrs, getattr)
+    assert old.getvalue() == new.getvalue(), "renderers differ"
+    print "%-16s %8d entries  per-call %.3fs  compiled %.3fs  x%.1f" % (
+        style, n, told, tnew, told / tnew)
+    results.append({ 'bench' : 'templates', 'style' : style, 'entries' : n,
+                     'legacy' : told, 'compiled' : tnew })
+
+# A DocBook style like simple-dotted, flexndex has no built-in one
+docbook_config = """
+[styles.simple-dotted.docbook45]
+levels.1.text_internal = <para>{ixterm}
+levels.1.link_last = <para><link linkend="ix{ixtgt}">{ixterm}</link></para>{nl}
+levels.1.text_last = <para>{ixterm}
+levels.1.multi_target = , <link linkend="ix{ixtgt}">{ixtext}</link>
+levels.2.text_internal = . {ixterm}
+levels.2.link_last = . <link linkend="ix{ixtgt}">{ixterm}</link></para>{nl}
+levels.2.text_last = . {ixterm}
+levels.2.multi_target = , <link linkend="ix{ixtgt}">{ixtext}</link>
+levels.3.text_internal = . {ixterm}
+levels.3.link_last = . <link linkend="ix{ixtgt}">{ixterm}</link></para>{nl}
+levels.3.text_last = . {ixterm}
+levels.3.multi_target = , <link linkend="ix{ixtgt}">{ixtext}</link>
+postfix = </para>{nl}
+"""
+
+document_wrap = {
+    'xhtml11' : ('<html><body>\n', '<p>%s</p>\n', '</body></html>\n'),
+    'docbook45' : ('<article>\n', '<para>%s</para>\n', '</article>\n'),
+}
+
+# Synthetic document of the backend, with n ix markers of up to depth terms
+# for n/targets distinct entries, so targets per entry on average, split
+# between index targets a and b.  After every n/heres markers there is an
+# ixhere of each of here_targets, alternately whole and collimated in 3
+# columns, or only whole if not cols.
+def make_document(path, n, heres=0, depth=3, targets=20, backend='xhtml11',
+                  seed=1, cols=True, here_targets=('a', 'b')):
+    r = random.Random(seed)
+    head, para, tail = document_wrap[backend]
+    pool = [ [ r.choice(words) for l in range(r.randint(0, depth-1)) ] + [ 'w%d' % i ]
+             for i in range(max(1, n/targets)) ]
+    with open(path, 'wb') as f:
+        f.write(head)
+        for i in range(n):
+            terms = list(r.choice(pool))
+            if r.random() < 0.2: terms.append('text=T%d' % r.randint(0, 99))
+            f.write(para % ('x <!-- ix %s <%s> --> y' % (r.choice(['a', 'b']),
+                                                          ','.join(terms))))
+            if heres and i % max(1, n / heres) == 0:
+                attrs = 'cols=3lc.1' if cols and i % 2 == 0 else ''
+                for t in here_targets:
+                    f.write('<!-- ixhere %s <%s> -->\n' % (t, attrs))
+        f.write(tail)
+
+# pass 1 keeping the index as dicts of str(rno) to attrs per terms and a
+# 5 tuple per mark, as flexndex did before the compact representation
+def legacy_scan(path):
+    inds = {}; marks = []; rno = 0
+    with open(path, 'rb') as f:
+        buf = f.read()
+    for m in flexndex.scan(buf, 0, len(buf)):
+        kind, pos, tgt, a, d = m
+        inds.setdefault(tgt, {}).setdefault(a, {})[str(rno)] = d
+        marks.append(('ix', pos, rno, a, d))
+        rno += 1
+    return inds, marks
+
+# run in a child process so the peak resident size is for one pass 1 only,
+# or for both passes of a document with whole indexes kept in memory or in
+# temporary files with a budget of 16MiB
+def memory_child(how, path):
+    def rss(): return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if how == 'legacy':
+        m = rss(); keep = legacy_scan(path)
+    elif how == 'indexer':
+        ix = flexndex.Indexer()
+        m = rss(); ix.scan(path); ix.close()
+    else:
+        ix = flexndex.Indexer(memory_budget=16<<20 if how == 'budget' else None)
+        m = rss(); ix.process(path, os.devnull)
+    print rss() - m
+
+def bench_memory(results, n):
+    fd, path = tempfile.mkstemp('.html'); os.close(fd)
+    try:
+        make_document(path, n, 2, cols=False)
+        res = {}
+        for how in [ 'legacy', 'indexer', 'memory', 'budget' ]:
+            out = subprocess.check_output([ sys.executable, __file__,
+                                            '--memory-child', how, path ])
+            res[how] = int(out) * 1024.0 / n
+    finally: os.remove(path)
+    print "pass 1 memory   %8d markers  dicts %.0f  compact %.0f bytes/marker  x%.1f" % (
+        n, res['legacy'], res['indexer'], res['legacy'] / res['indexer'])
+    print "process memory  %8d markers  in memory %.1f  16MiB budget %.1f MiB" % (
+        n, res['memory'] * n / 1048576, res['budget'] * n / 1048576)
+    results.append({ 'bench' : 'memory', 'markers' : n,
+                     'legacy' : res['legacy'], 'compact' : res['indexer'],
+                     'in memory' : res['memory'], 'budget' : res['budget'] })
+
+# pass 2 output rate to an unbuffered file, through the write buffer and
+# with os.write
+def bench_output(results, n, heres=2):
+    fd, path = tempfile.mkstemp('.html'); os.close(fd)
+    out = path + '.out'
+    try:
+        make_document(path, n, heres)
+        for name, size, direct in [ ('unbuffered', 0, False),
+                                    ('buffered', 1<<20, False),
+                                    ('os.write', 1<<20, True) ]:
+            ix = flexndex.Indexer(write_buffer=size, direct=direct)
+            ix.scan(path)
+            with open(out, 'wb', -1 if size else 0) as o:
+                t = timed(ix.render, path, o)
+            ix.close()
+            mb = os.path.getsize(out) / 1048576.0
+            print "pass 2 output   %8d markers  %-10s %7.1f MB  %6.1f MB/s" % (
+                n, name, mb, mb / t)
+            results.append({ 'bench' : 'output', 'markers' : n, 'mode' : name,
+                             'MB' : mb, 'MB/s' : mb / t })
+    finally:
+        os.remove(path)
+        if os.path.exists(out): os.remove(out)
+
+# anchors rendered as a template against the prebuilt format, and pass 2
+# of a document whose index b has no ixhere with all anchors and with only
+# the anchors of index a
+def bench_anchors(results, n):
+    ix = flexndex.Indexer()
+    o = flexndex.Block()
+    ta = timed(lambda: [ ix.subout(o, ix.anchor, ixtgt=str(i)) for i in xrange(n) ])
+    del o[:]
+    fmt = ix.anchor_format
+    tf = timed(lambda: [ o.write(fmt % { 'ixtgt' : i }) for i in xrange(n) ])
+    print "anchors         %8d anchors  template %.3fs  format %.3fs  x%.1f" % (
+        n, ta, tf, ta / tf)
+    results.append({ 'bench' : 'anchors', 'anchors' : n,
+                     'template' : ta, 'format' : tf })
+    fd, path = tempfile.mkstemp('.html'); os.close(fd)
+    out = path + '.out'
+    try:
+        make_document(path, n, 2, here_targets=('a',))
+        res = {}
+        for used in [ False, True ]:
+            ix = flexndex.Indexer(used_anchors=used)
+            ix.scan(path)
+            with open(out, 'wb') as f:
+                res[used] = timed(ix.render, path, f), os.path.getsize(out) / 1048576.0
+            ix.close()
+        print "used anchors    %8d markers  all %.3fs %.1f MB  used %.3fs %.1f MB" % (
+            n, res[False][0], res[False][1], res[True][0], res[True][1])
+        results.append({ 'bench' : 'used anchors', 'markers' : n,
+                         'all' : res[False][0], 'all MB' : res[False][1],
+                         'used' : res[True][0], 'used MB' : res[True][1] })
+    finally:
+        os.remove(path)
+        if os.path.exists(out): os.remove(out)
+
+# indexing a document again with the Indexer and Cache kept in memory, as
+# --watch and --serve do, unchanged, after a text edit and after an ix
+# comment is added, against indexing it first
+def bench_hot(results, n, heres=2):
+    fd, path = tempfile.mkstemp('.html'); os.close(fd)
+    out = path + '.out'
+    try:
+        make_document(path, n, heres)
+        with open(path, 'rb') as f: text = f.read()
+        mid = text.index('<p>', len(text) // 2)
+        edits = [ ('unchanged', text),
+                  ('text edit', text[:mid] + '<p>edited</p>\n' + text[mid:]),
+                  ('ix added', text[:mid] + '<p><!-- ix a <w0> --></p>\n' + text[mid:]) ]
+        cache = flexndex.Cache()
+        ix = flexndex.Indexer(cache=cache)
+        first = timed(ix.index_files, [ (path, out) ])
+        res = { 'markers' : n, 'first' : first }
+        line = "hot index       %8d markers  first %.3fs" % (n, first)
+        for name, doc in edits:
+            with open(path, 'wb') as f: f.write(doc)
+            cache.next_run(); ix.reset()
+            res[name] = timed(ix.index_files, [ (path, out) ])
+            line += "  %s %.3fs" % (name, res[name])
+            with open(path, 'wb') as f: f.write(text)
+            cache.next_run(); ix.reset(); ix.index_files([ (path, out) ])
+        print line
+        res['bench'] = 'hot'
+        results.append(res)
+    finally:
+        os.remove(path)
+        if os.path.exists(out): os.remove(out)
+
+# pass 2 of a document with many large indexes, the indexes made by each
+# number of worker processes in jobs, the speedup is against 1
+def bench_parallel(results, n, jobs, heres=8):
+    import multiprocessing
+    fd, path = tempfile.mkstemp('.html'); os.close(fd)
+    out = path + '.out'
+    try:
+        make_document(path, n, heres)
+        ix = flexndex.Indexer()
+        ix.scan(path)
+        base = None
+        for j in jobs:
+            t = timed(ix.render, path, out, j)
+            if base is None: base = t
+            print "parallel render %8d markers  %2d ixheres  %2d jobs  %.3fs  x%.2f  (%d cpus)" % (
+                n, 2 * heres, j, t, base / t, multiprocessing.cpu_count())
+            results.append({ 'bench' : 'parallel', 'markers' : n, 'jobs' : j,
+                             'ixheres' : 2 * heres, 'seconds' : t,
+                             'speedup' : base / t,
+                             'cpus' : multiprocessing.cpu_count() })
+        ix.close()
+    finally:
+        os.remove(path)
+        if os.path.exists(out): os.remove(out)
+
+# The marker regexes flexndex applied to each line before the combined
+# scanner, kept here only as the baseline for comparison.
+legacy_ix_re = flexndex.re.compile(r'<!-- ix (?P<target>\S+) <(?P<attrlist>[^>]*)> -->')
+legacy_ixhere_re = flexndex.re.compile(r'<!-- ixhere (?P<target>\S+) <(?P<attrlist>[^>]*)> -->')
+
+def scan_lines(buf):
+    n = 0
+    for line in cStringIO.StringIO(buf):
+        for m in legacy_ix_re.finditer(line): n += 1
+        if legacy_ixhere_re.search(line): n += 1
+    return n
+
+def scan_finditer(buf):
+    n = 0
+    for m in flexndex.marker_re.finditer(buf): n += 1
+    return n
+
+def scan_skip(buf):
+    n = 0
+    pos = buf.find(flexndex.marker_start)
+    if pos < 0: return n
+    for m in flexndex.marker_re.finditer(buf, pos): n += 1
+    return n
+
+def scan_prefilter(buf):
+    n = 0; find = buf.find; match = flexndex.marker_re.match
+    pos = find(flexndex.marker_start)
+    while pos >= 0:
+        m = match(buf, pos)
+        if m is None: pos = find(flexndex.marker_start, pos + 7); continue
+        n += 1; pos = find(flexndex.marker_start, m.end())
+    return n
+
+# Finding the markers of a document of n lines, per line with the old
+# regexes, with the combined regex over the buffer, skipping to the first
+# candidate with a string search then the combined regex as scan() does,
+# and matching each candidate the string search finds.  Sparse has a
+# marker every 100 lines and other comments, dense three markers on every
+# line, and late is n lines with no markers followed by sparse.
+def bench_scan(results, n):
+    r = random.Random(1); docs = {}
+    lines = []
+    for i in range(n):
+        if i % 100 == 0: lines.append('<p>x <!-- ix a <%s> --> y</p>\n' % r.choice(words))
+        elif i % 10 == 0: lines.append('<!-- a comment --> <p>%s</p>\n' % r.choice(words))
+        else: lines.append('<p>Some text without any markers %s</p>\n' % r.choice(words))
+    docs['sparse'] = ''.join(lines)
+    docs['late'] = ''.join(l for l in lines if '<!-- ix' not in l)
+    docs['dense'] = ''.join('<p>%s <!-- ix a <%s> --> and <!-- ix b <%s,%s> --> '
+                            'or <!-- ix a <%s> --></p>\n' % ((i,) + tuple(
+                            r.choice(words) for j in range(4))) for i in range(n))
+    docs['late'] += docs['sparse']
+    names = [ 'per-line', 'finditer', 'skip', 'prefilter' ]
+    for kind in [ 'sparse', 'dense', 'late' ]:
+        buf = docs[kind]; times = {}; counts = set()
+        for name, fn in zip(names, [ scan_lines, scan_finditer, scan_skip,
+                                     scan_prefilter ]):
+            t = time.time(); counts.add(fn(buf)); times[name] = time.time() - t
+        assert len(counts) == 1, "scanners differ"
+        print "scan %-6s %8d lines  %s" % (kind, n, '  '.join(
+            '%s %.3fs' % (name, times[name]) for name in names))
+        r = { 'bench' : 'scan', 'document' : kind, 'lines' : n }
+        r.update(times)
+        results.append(r)
+
+# Time each phase separately for a document of n markers:
+#   parse - Settings.parse of the configuration, the mean of 20
+#   pass1 - Indexer.scan
+#   pass2 - Indexer.render
+#   collimate - collimate() of the entries of index a in 3 columns
+#   subout - Indexer.subout of link_last for each of those entries
+def bench_phases(results, n, backend, depth, targets, heres):
+    fd, path = tempfile.mkstemp('.xml'); os.close(fd)
+    conf = path + '.conf'; out = path + '.out'
+    try:
+        make_document(path, n, heres, depth, targets, backend)
+        with open(conf, 'wb') as f: f.write(docbook_config)
+        text = flexndex.styles_config + docbook_config; reps = 20
+        def parse():
+            for i in range(reps):
+                with closing(cStringIO.StringIO(text)) as fo:
+                    flexndex.Settings().parse(fo)
+        times = { 'parse' : timed(parse) / reps }
+        ix = flexndex.Indexer(backend, [ conf ])
+        times['pass1'] = timed(ix.scan, path)
+        with open(out, 'wb') as o:
+            times['pass2'] = timed(ix.render, path, o)
+        ix.close()
+        styleob = ix.styles.get(flexndex.default_style, ix.backend)
+        entries = flexndex.tree_entries(ix.inds.get('a', flexndex.TermNode()),
+                                        (), styleob.complete[:1])
+        times['collimate'] = timed(flexndex.collimate, entries,
+                                   { 'cols' : '3lc.1' }, styleob, 0)
+        link = styleob.levels[0].link_last; b = flexndex.Block()
+        hereattrs = { 'ixfile' : '' }
+        def subout():
+            for e in entries:
+                if not e.targets: continue
+                rn = e.targets[0]
+                ix.subout(b, link, ix.tattrs[rn], hereattrs, ixterm=e.terms[-1],
+                          ixtgt=str(rn), ixtext=ix.texts[rn], ixindent='0')
+        times['subout'] = timed(subout)
+    finally:
+        for f in (path, conf, out):
+            if os.path.exists(f): os.remove(f)
+    print "phases %-9s %8d markers  %s" % (backend, n, '  '.join(
+        '%s %.4fs' % (k, times[k]) for k in
+        ('parse', 'pass1', 'pass2', 'collimate', 'subout')))
+    r = { 'bench' : 'phases', 'backend' : backend, 'markers' : n,
+          'depth' : depth, 'targets' : targets, 'heres' : heres,
+          'entries' : len(entries) }
+    r.update(times)
+    results.append(r)
+
+# Start up of runs on small documents, each in a new interpreter: the bare
+# interpreter, importing flexndex, main() on an empty and a small document
+# and running flexndex.py as a script, which python compiles every time.
+# The median wall time of runs of each is reported, the runs of all of them
+# interleaved so a change in the machine's load affects each alike.
+# flexndex is imported from a copy with its bytecode compiled, as when
+# installed.  Python 2 has no -X importtime, the modules importing flexndex
+# loads are counted.
+#
+# The same runs of a baseline flexndex.py, by default the one of the first
+# commit of the repository, are timed with them for comparison.  Its
+# main() takes the arguments from sys.argv only.
+startup_runs = [
+    ('interpreter', [ '-c', 'pass' ]),
+    ('import', [ '-c', 'import flexndex' ]),
+    ('empty', [ '-c', 'import flexndex; flexndex.main([%(empty)r, %(null)r])' ]),
+    ('small', [ '-c', 'import flexndex; flexndex.main([%(small)r, %(null)r])' ]),
+    ('script', [ '%(script)s', '%(empty)s', '%(null)s' ]),
+]
+baseline_runs = [
+    ('baseline import', [ '-c', 'import flexndex' ]),
+    ('baseline empty', [ '-c', 'import sys, flexndex; '
+                         'sys.argv[1:] = [%(empty)r, %(null)r]; flexndex.main()' ]),
+    ('baseline small', [ '-c', 'import sys, flexndex; '
+                         'sys.argv[1:] = [%(small)r, %(null)r]; flexndex.main()' ]),
+    ('baseline script', [ '%(script)s', '%(empty)s', '%(null)s' ]),
+]
+
+def first_commit_source():
+    "flexndex.py of the first commit of the repository, or None"
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        with open(os.devnull, 'w') as null:
+            root = subprocess.check_output([ 'git', 'rev-list',
+                '--max-parents=0', 'HEAD' ], cwd=here, stderr=null).split()[-1]
+            return subprocess.check_output([ 'git', 'show',
+                root + ':flexndex.py' ], cwd=here, stderr=null)
+    except (OSError, subprocess.CalledProcessError, IndexError): return None
+
+def bench_startup(results, runs=20, baseline=None):
+    """Time startup_runs of flexndex and baseline_runs of baseline, the path
+       of a baseline flexndex.py, or if None that of the first commit"""
+    d = tempfile.mkdtemp()
+    try:
+        def copy(name, source):
+            os.mkdir(os.path.join(d, name))
+            script = os.path.join(d, name, 'flexndex.py')
+            with open(script, 'wb') as f: f.write(source)
+            py_compile.compile(script)
+            return script
+        def count(cwd):
+            return int(subprocess.check_output([ sys.executable, '-c',
+                'import sys; m = len(sys.modules); import flexndex; '
+                'print len(sys.modules) - m' ], cwd=cwd))
+        with open(flexndex.__file__.replace('.pyc', '.py'), 'rb') as f:
+            script = copy('new', f.read())
+        if baseline is not None:
+            with open(baseline, 'rb') as f: baseline = f.read()
+        else: baseline = first_commit_source()
+        names = { 'null' : os.devnull, 'empty' : os.path.join(d, 'empty.html'),
+                  'small' : os.path.join(d, 'small.html') }
+        open(names['empty'], 'wb').close()
+        # not collimated, the baseline fails on some collimated indexes
+        make_document(names['small'], 20, 1, cols=False)
+        cmds = []
+        for name, args in startup_runs:
+            names['script'] = script
+            cmds.append((name, [ a % names for a in args ], os.path.dirname(script)))
+        modules = { 'modules' : count(os.path.dirname(script)) }
+        order = startup_runs
+        if baseline is not None:
+            old = copy('baseline', baseline)
+            for name, args in baseline_runs:
+                names['script'] = old
+                cmds.append((name, [ a % names for a in args ], os.path.dirname(old)))
+            modules['baseline modules'] = count(os.path.dirname(old))
+            order = startup_runs + baseline_runs
+        else: print "startup  no baseline, flexndex.py of the first commit not found"
+        ts = dict((name, []) for name, args, cwd in cmds)
+        for i in range(runs):
+            for name, args, cwd in cmds:
+                t = time.time(); subprocess.check_call([ sys.executable ] + args, cwd=cwd)
+                ts[name].append(time.time() - t)
+        times = dict((name, sorted(t)[runs/2]) for name, t in ts.items())
+    finally: shutil.rmtree(d)
+    print "startup  %s  %s" % ('  '.join('%s %.1fms' % (k, times[k] * 1e3)
+        for k, a in order), '  '.join('%s %d' % m for m in sorted(modules.items())))
+    r = { 'bench' : 'startup', 'runs' : runs }
+    r.update(times); r.update(modules)
+    results.append(r)
+
+def main():
+    p = argparse.ArgumentParser(description='flexndex benchmarks')
+    p.add_argument('--suite', default='all',
+                   choices=[ 'all', 'phases', 'templates', 'scan', 'memory',
+                             'output', 'anchors', 'hot', 'parallel',
+                             'startup' ])
+    p.add_argument('--scales', default='1000,100000,1000000',
+                   help='Comma separated numbers of markers for the phases')
+    p.add_argument('--backend', action='append',
+                   choices=[ 'xhtml11', 'docbook45' ],
+                   help='Backends of the documents for the phases, default both')
+    p.add_argument('--depth', type=int, default=3, help='Most terms per entry')
+    p.add_argument('--targets', type=int, default=20,
+                   help='Mean targets per entry')
+    p.add_argument('--heres', type=int, default=4,
+                   help='ixhere comments per index target')
+    p.add_argument('--entries', '-n', type=int, default=100000,
+                   help='Entries for the template benchmark')
+    p.add_argument('--markers', '-m', type=int, default=1000000,
+                   help='Markers for the memory and output benchmarks')
+    p.add_argument('--jobs', default='1,2,4,8',
+                   help='Comma separated numbers of worker processes for the '
+                        'parallel render, the first is the baseline')
+    p.add_argument('--baseline', help='flexndex.py to compare the startup '
+                   'with, default that of the first commit')
+    p.add_argument('--json', help='File to write the results to')
+    p.add_argument('--memory-child', nargs=2, help=argparse.SUPPRESS)
+    a = p.parse_args()
+    if a.memory_child: return memory_child(*a.memory_child)
+    results = []
+    if a.suite in ('all', 'phases'):
+        for n in [ int(x) for x in a.scales.split(',') ]:
+            for backend in a.backend or [ 'xhtml11', 'docbook45' ]:
+                bench_phases(results, n, backend, a.depth, a.targets, a.heres)
+    if a.suite in ('all', 'templates'):
+        for style in [ 'simple-dotted', 'simple-grouped', 'column-grouped' ]:
+            bench_templates(results, a.entries, style)
+    if a.suite in ('all', 'scan'):
+        bench_scan(results, a.markers)
+    if a.suite in ('all', 'memory'):
+        bench_memory(results, a.markers)
+    if a.suite in ('all', 'output'):
+        bench_output(results, a.markers / 10)
+    if a.suite in ('all', 'anchors'):
+        bench_anchors(results, a.markers / 10)
+    if a.suite in ('all', 'hot'):
+        bench_hot(results, a.markers / 10)
+    if a.suite in ('all', 'parallel'):
+        bench_parallel(results, a.markers / 10,
+                       [ int(x) for x in a.jobs.split(',') ])
+    if a.suite in ('all', 'startup'):
+        bench_startup(results, baseline=a.baseline)
+    if a.json:
+        with open(a.json, 'w') as f:
+            json.dump({ 'python' : platform.python_version(),
+                        'date' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+                        'results' : results }, f, indent=1, sort_keys=True)
+    return 0
+
+if __name__ == '__main__':
+    main()